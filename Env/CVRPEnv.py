@@ -25,8 +25,8 @@ class Step_CVRP_State:
     # shape: (batch, pomo)
     current_node: torch.Tensor = None
     # shape: (batch, pomo)
-    ninf_mask: torch.Tensor = None
-    # shape: (batch, pomo, problem+1)
+    mask: torch.Tensor = None
+    # shape: (batch, pomo, problem+1), True for the nodes that can not be selected
     finished: torch.Tensor = None
     # shape: (batch, pomo)
 
@@ -62,7 +62,10 @@ class CVRPEnv:
         self.selected_count = None
         self.current_node = None
         # shape: (batch, pomo)
-        self.selected_node_list = None
+        self.last_xy = None
+        # shape: (batch, pomo, 2)
+        self.travel_distance = None
+        # shape: (batch, pomo), from the depot to the current node
         # shape: (batch, pomo, 0~)
 
         # Dynamic-2
@@ -71,13 +74,20 @@ class CVRPEnv:
         # shape: (batch, pomo)
         self.load = None
         # shape: (batch, pomo)
-        self.visited_ninf_flag = None
+        self.visited_flag = None
         # shape: (batch, pomo, problem+1)
-        self.ninf_mask = None
+        self.mask = None
         # shape: (batch, pomo, problem+1)
         self.finished = None
         # shape: (batch, pomo)
 
+        # Compaction
+        ####################################
+        self.instance_idx = None
+        # shape: (batch,), index in the loaded batch of the instances still decoded, None if not compacted
+        self.travel_distance_all = None
+        # shape: (loaded batch, pomo), final distances of the dropped instances
+
         # states to return
         ####################################
         self.reset_state = Reset_CVRP_State()
@@ -92,18 +102,22 @@ class CVRPEnv:
         self.saved_node_demand = loaded_dict['node_demand']
         self.saved_index = 0
 
-    def generate_data(self,batch_size):
-        depot_xy, node_xy, node_demand = get_random_cvrp_problems(batch_size, self.problem_size)
-        instance = torch.zeros(node_xy.shape[0],node_xy.shape[1]+1,3)
+    def generate_data(self,batch_size, device=None, generator=None):
+        depot_xy, node_xy, node_demand = get_random_cvrp_problems(batch_size, self.problem_size, device, generator)
+        instance = torch.zeros(node_xy.shape[0],node_xy.shape[1]+1,3, device=node_xy.device)
         instance[:,0:1,:2] = depot_xy
         instance[:,1:,:2] = node_xy
         instance[:,1:,2] = node_demand
         return instance
 
-    def load_problems(self, batch_size, aug_factor=1, prepare_dataset=None):
+    def random_problems(self, batch_size, device=None):
+        return get_random_cvrp_problems(batch_size, self.problem_size, device)
+
+    def load_problems(self, batch_size, aug_factor=1, prepare_dataset=None, generated=None):
+        # generated: the output of random_problems, e.g. prefetched, used instead of new random problems
         if prepare_dataset is None:
             self.batch_size = batch_size
-            depot_xy, node_xy, node_demand = get_random_cvrp_problems(batch_size, self.problem_size)
+            depot_xy, node_xy, node_demand = self.random_problems(batch_size) if generated is None else generated
         else:
             self.batch_size = prepare_dataset.shape[0]
             self.problem_size = prepare_dataset.shape[1]-1
@@ -140,20 +154,24 @@ class CVRPEnv:
         self.step_state.BATCH_IDX = self.BATCH_IDX
         self.step_state.POMO_IDX = self.POMO_IDX
 
+        self.instance_idx = None
+        self.travel_distance_all = None
+
     def reset(self):
         self.selected_count = 0
         self.current_node = None
         # shape: (batch, pomo)
-        self.selected_node_list = torch.zeros((self.batch_size, self.pomo_size, 0), dtype=torch.long)
-        # shape: (batch, pomo, 0~)
+        self.last_xy = None
+        self.travel_distance = torch.zeros(size=(self.batch_size, self.pomo_size))
+        # shape: (batch, pomo)
 
         self.at_the_depot = torch.ones(size=(self.batch_size, self.pomo_size), dtype=torch.bool)
         # shape: (batch, pomo)
         self.load = torch.ones(size=(self.batch_size, self.pomo_size))
         # shape: (batch, pomo)
-        self.visited_ninf_flag = torch.zeros(size=(self.batch_size, self.pomo_size, self.problem_size+1))
+        self.visited_flag = torch.zeros(size=(self.batch_size, self.pomo_size, self.problem_size+1), dtype=torch.bool)
         # shape: (batch, pomo, problem+1)
-        self.ninf_mask = torch.zeros(size=(self.batch_size, self.pomo_size, self.problem_size+1))
+        self.mask = torch.zeros(size=(self.batch_size, self.pomo_size, self.problem_size+1), dtype=torch.bool)
         # shape: (batch, pomo, problem+1)
         self.finished = torch.zeros(size=(self.batch_size, self.pomo_size), dtype=torch.bool)
         # shape: (batch, pomo)
@@ -166,7 +184,7 @@ class CVRPEnv:
         self.step_state.selected_count = self.selected_count
         self.step_state.load = self.load
         self.step_state.current_node = self.current_node
-        self.step_state.ninf_mask = self.ninf_mask
+        self.step_state.mask = self.mask
         self.step_state.finished = self.finished
 
         reward = None
@@ -181,8 +199,11 @@ class CVRPEnv:
         self.selected_count += 1
         self.current_node = selected
         # shape: (batch, pomo)
-        self.selected_node_list = torch.cat((self.selected_node_list, self.current_node[:, :, None]), dim=2)
-        # shape: (batch, pomo, 0~)
+        current_xy = self.depot_node_xy[self.BATCH_IDX, selected]
+        # shape: (batch, pomo, 2)
+        if self.last_xy is not None:
+            self.travel_distance += ((current_xy - self.last_xy) ** 2).sum(2).sqrt()
+        self.last_xy = current_xy
 
         # Dynamic-2
         ####################################
@@ -197,54 +218,78 @@ class CVRPEnv:
         self.load -= selected_demand
         self.load[self.at_the_depot] = 1 # refill loaded at the depot
 
-        self.visited_ninf_flag[self.BATCH_IDX, self.POMO_IDX, selected] = float('-inf')
+        self.visited_flag[self.BATCH_IDX, self.POMO_IDX, selected] = True
         # shape: (batch, pomo, problem+1)
-        self.visited_ninf_flag[:, :, 0][~self.at_the_depot] = 0  # depot is considered unvisited, unless you are AT the depot
+        self.visited_flag[:, :, 0] = self.at_the_depot  # depot is considered unvisited, unless you are AT the depot
 
-        self.ninf_mask = self.visited_ninf_flag.clone()
         round_error_epsilon = 0.00001
-        demand_too_large = self.load[:, :, None] + round_error_epsilon < demand_list
-        # shape: (batch, pomo, problem+1)
-        self.ninf_mask[demand_too_large] = float('-inf')
+        torch.lt(self.load[:, :, None] + round_error_epsilon, demand_list, out=self.mask)
+        # shape: (batch, pomo, problem+1), demand too large
+        self.mask |= self.visited_flag
         # shape: (batch, pomo, problem+1)
 
-        newly_finished = (self.visited_ninf_flag == float('-inf')).all(dim=2)
+        newly_finished = self.visited_flag.all(dim=2)
         # shape: (batch, pomo)
         self.finished = self.finished + newly_finished
         # shape: (batch, pomo)
 
         # do not mask depot for finished episode.
-        self.ninf_mask[:, :, 0][self.finished] = 0
+        self.mask[:, :, 0] &= ~self.finished
 
         self.step_state.selected_count = self.selected_count
         self.step_state.load = self.load
         self.step_state.current_node = self.current_node
-        self.step_state.ninf_mask = self.ninf_mask
+        self.step_state.mask = self.mask
         self.step_state.finished = self.finished
 
         # returning values
         done = self.finished.all()
         if done:
-            reward = -self._get_travel_distance()  # note the minus sign!
+            travel_distance = self._get_travel_distance()
+            if self.instance_idx is not None:
+                self.travel_distance_all[self.instance_idx] = travel_distance
+                travel_distance = self.travel_distance_all
+            reward = -travel_distance  # note the minus sign!
         else:
             reward = None
 
         return self.step_state, reward, done
 
-    def _get_travel_distance(self):
-        gathering_index = self.selected_node_list[:, :, :, None].expand(-1, -1, -1, 2)
-        # shape: (batch, pomo, selected_list_length, 2)
-        all_xy = self.depot_node_xy[:, None, :, :].expand(-1, self.pomo_size, -1, -1)
-        # shape: (batch, pomo, problem+1, 2)
-
-        ordered_seq = all_xy.gather(dim=2, index=gathering_index)
-        # shape: (batch, pomo, selected_list_length, 2)
+    def compact(self, keep):
+        # keep.shape: (batch,), bool, the instances to go on decoding, the others must be finished
+        # drops the other instances from the rollout until the next load_problems, their distances (with the way
+        # back to the depot) are kept for the reward, which is returned for the whole loaded batch
+        if self.instance_idx is None:
+            self.instance_idx = torch.arange(self.batch_size)
+            self.travel_distance_all = torch.zeros(size=(self.batch_size, self.pomo_size))
+        self.travel_distance_all[self.instance_idx[~keep]] = self._get_travel_distance()[~keep]
+
+        self.instance_idx = self.instance_idx[keep]
+        self.batch_size = self.instance_idx.size(0)
+        self.BATCH_IDX = torch.arange(self.batch_size)[:, None].expand(self.batch_size, self.pomo_size)
+        self.POMO_IDX = torch.arange(self.pomo_size)[None, :].expand(self.batch_size, self.pomo_size)
+        self.depot_node_xy = self.depot_node_xy[keep]
+        self.depot_node_demand = self.depot_node_demand[keep]
+
+        self.current_node = self.current_node[keep]
+        self.at_the_depot = self.at_the_depot[keep]
+        self.load = self.load[keep]
+        self.visited_flag = self.visited_flag[keep]
+        self.mask = self.mask[keep]
+        self.finished = self.finished[keep]
+        self.last_xy = self.last_xy[keep]
+        self.travel_distance = self.travel_distance[keep]
 
-        rolled_seq = ordered_seq.roll(dims=2, shifts=-1)
-        segment_lengths = ((ordered_seq-rolled_seq)**2).sum(3).sqrt()
-        # shape: (batch, pomo, selected_list_length)
+        self.step_state.BATCH_IDX = self.BATCH_IDX
+        self.step_state.POMO_IDX = self.POMO_IDX
+        self.step_state.load = self.load
+        self.step_state.current_node = self.current_node
+        self.step_state.mask = self.mask
+        self.step_state.finished = self.finished
+        return self.step_state
 
-        travel_distances = segment_lengths.sum(2)
+    def _get_travel_distance(self):
+        # the distance accumulated in step() plus the segment back to the depot (the first node of every tour)
+        travel_distances = self.travel_distance + ((self.depot_node_xy[:, None, 0, :] - self.last_xy) ** 2).sum(2).sqrt()
         # shape: (batch, pomo)
         return travel_distances
-
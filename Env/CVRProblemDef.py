@@ -3,12 +3,12 @@ import torch
 import numpy as np
 
 
-def get_random_cvrp_problems(batch_size, problem_size):
+def get_random_cvrp_problems(batch_size, problem_size, device=None, generator=None):
 
-    depot_xy = torch.rand(size=(batch_size, 1, 2))
+    depot_xy = torch.rand(size=(batch_size, 1, 2), device=device, generator=generator)
     # shape: (batch, 1, 2)
 
-    node_xy = torch.rand(size=(batch_size, problem_size, 2))
+    node_xy = torch.rand(size=(batch_size, problem_size, 2), device=device, generator=generator)
     # shape: (batch, problem, 2)
 
     if problem_size >= 20 and problem_size < 50:
@@ -20,7 +20,8 @@ def get_random_cvrp_problems(batch_size, problem_size):
     else:
         raise NotImplementedError
 
-    node_demand = torch.randint(1, 10, size=(batch_size, problem_size)) / float(demand_scaler)
+    node_demand = torch.randint(1, 10, size=(batch_size, problem_size), device=device,
+                                generator=generator) / float(demand_scaler)
     # shape: (batch, problem)
 
     return depot_xy, node_xy, node_demand
@@ -22,9 +22,10 @@ class Step_State:
     accumulated_value:torch.Tensor = None
     capacity:torch.Tensor = None
     ninf_mask_w_dummy: torch.Tensor = None
-    ninf_mask: torch.Tensor = None
-    # shape: (batch, pomo, node)
-    fit_ninf_mask: torch.Tensor = None
+    mask: torch.Tensor = None
+    # shape: (batch, pomo, node), True for the selected items
+    fit_mask: torch.Tensor = None
+    # shape: (batch, pomo, node), True for the items that can not be selected
     finished: torch.Tensor = None
     # shape: (batch, pomo)
 
@@ -41,6 +42,11 @@ class KPEnv:
         self.saved_item_data = None
         self.saved_index = None
 
+        self.instance_idx = None
+        # shape: (batch,), index in the loaded batch of the instances still decoded, None if not compacted
+        self.accumulated_value_all = None
+        # shape: (loaded batch, pomo), final values of the dropped instances
+
     def use_saved_problems(self, filename, device):
         self.FLAG__use_saved_problems = True
 
@@ -48,20 +54,33 @@ class KPEnv:
         self.saved_item_data = loaded_dict['item_data']
         self.saved_index = 0
 
-    def generate_data(self,batch_size):
-        return get_random_problems(batch_size, self.problem_size)
+    def generate_data(self,batch_size, device=None, generator=None):
+        return get_random_problems(batch_size, self.problem_size, device, generator)
+
+    def random_problems(self, batch_size, device=None):
+        return get_random_problems(batch_size, self.problem_size, device)
 
-    def load_problems(self, batch_size, aug_factor=1, prepare_dataset=None):
+    def load_problems(self, batch_size, aug_factor=1, prepare_dataset=None, generated=None):
+        # generated: the output of random_problems, e.g. prefetched, used instead of new random problems
         if prepare_dataset is None:
             self.batch_size = batch_size
-            self.problems = get_random_problems(batch_size, self.problem_size)
+            self.problems = self.random_problems(batch_size) if generated is None else generated
         else:
             self.batch_size = prepare_dataset.shape[0]
             self.problems = prepare_dataset
+        # problems.shape: (batch, problem, 2), weight and value
+
+        self.sorted_weight, order = self.problems[:, :, 0].sort(dim=1)
+        # shape: (batch, problem)
+        self.weight_rank = order.argsort(dim=1)
+        # shape: (batch, problem), position of each item in sorted_weight
 
         self.BATCH_IDX = torch.arange(self.batch_size)[:, None].expand(self.batch_size, self.pomo_size)
         self.POMO_IDX = torch.arange(self.pomo_size)[None, :].expand(self.batch_size, self.pomo_size)
 
+        self.instance_idx = None
+        self.accumulated_value_all = None
+
     def reset(self):
         if self.problem_size >= 20 and self.problem_size < 50:
             capacity = 6.25
@@ -80,9 +99,10 @@ class KPEnv:
         # shape = (batch, group)
         self.step_state.capacity = torch.ones((self.batch_size, self.pomo_size)) * capacity
         # shape = (batch, group)
-        self.step_state.ninf_mask = torch.zeros((self.batch_size, self.pomo_size, self.problem_size))
+        self.step_state.mask = torch.zeros((self.batch_size, self.pomo_size, self.problem_size), dtype=torch.bool)
+        # shape = (batch, group, problem)
+        self.step_state.fit_mask = torch.zeros((self.batch_size, self.pomo_size, self.problem_size), dtype=torch.bool)
         # shape = (batch, group, problem)
-        self.step_state.fit_ninf_mask = None
         self.step_state.finished = torch.zeros((self.batch_size, self.pomo_size))==1.
 
         reward = None
@@ -105,38 +125,64 @@ class KPEnv:
 
         # Dynamic-2
         ####################################
-        items_mat = self.problems[:, None, :, :].expand(self.batch_size, self.pomo_size, self.problem_size, 2)
-        gathering_index = selected[:, :, None, None].expand(self.batch_size, self.pomo_size, 1, 2)
-        selected_item = items_mat.gather(dim=2, index=gathering_index).squeeze(dim=2)
+        selected_item = self.problems[self.BATCH_IDX, selected]
         # shape = (batch, pomo, 2)
-
-        selected_item[self.step_state.finished[:,:,None].expand(self.batch_size, self.pomo_size, 2)==True] = 0.
+        selected_item.masked_fill_(self.step_state.finished[:, :, None], 0.)
 
         self.step_state.accumulated_value += selected_item[:, :, 1]
         self.step_state.capacity -= selected_item[:, :, 0]
 
-        self.step_state.ninf_mask[self.BATCH_IDX, self.POMO_IDX, selected] = float('-inf')
+        self.step_state.mask[self.BATCH_IDX, self.POMO_IDX, selected] = True
 
-        unfit_bool = (self.step_state.capacity[:, :, None] - self.problems[:, None, :, 0]) < 0
-        # shape = (batch, group, problem)
-        self.step_state.fit_ninf_mask = self.step_state.ninf_mask.clone()
-        self.step_state.fit_ninf_mask[unfit_bool] = float('-inf')
+        # the items heavier than the capacity are the ones after the fitting ones in sorted_weight
+        fit_count = torch.searchsorted(self.sorted_weight, self.step_state.capacity, right=True)
+        # shape = (batch, group)
+        torch.ge(self.weight_rank[:, None, :], fit_count[:, :, None], out=self.step_state.fit_mask)
+        # shape = (batch, group, problem), unfit items
+        self.step_state.fit_mask |= self.step_state.mask
 
-        self.step_state.finished = (self.step_state.fit_ninf_mask == float('-inf')).all(dim=2)
+        self.step_state.finished = self.step_state.fit_mask.all(dim=2)
         # shape = (batch, group)
-        if (self.step_state.finished==True).any():
-            idx= torch.where(self.step_state.finished==True)
-            # idx_ = torch.zeros_like(idx[0]).to(torch.int8)
-            self.step_state.fit_ninf_mask[idx[0],idx[1],0] = 0
+        self.step_state.fit_mask[:, :, 0] &= ~self.step_state.finished
 
         # returning values
         done = self.step_state.finished.all()
         if done:
             reward = self.step_state.accumulated_value
+            if self.instance_idx is not None:
+                self.accumulated_value_all[self.instance_idx] = reward
+                reward = self.accumulated_value_all
         else:
             reward = None
         return self.step_state, reward, done
 
+    def compact(self, keep):
+        # keep.shape: (batch,), bool, the instances to go on decoding, the others must be finished
+        # drops the other instances from the rollout until the next load_problems, their values are kept for the
+        # reward, which is returned for the whole loaded batch
+        if self.instance_idx is None:
+            self.instance_idx = torch.arange(self.batch_size)
+            self.accumulated_value_all = torch.zeros((self.batch_size, self.pomo_size))
+        self.accumulated_value_all[self.instance_idx[~keep]] = self.step_state.accumulated_value[~keep]
+
+        self.instance_idx = self.instance_idx[keep]
+        self.batch_size = self.instance_idx.size(0)
+        self.BATCH_IDX = torch.arange(self.batch_size)[:, None].expand(self.batch_size, self.pomo_size)
+        self.POMO_IDX = torch.arange(self.pomo_size)[None, :].expand(self.batch_size, self.pomo_size)
+        self.problems = self.problems[keep]
+        self.sorted_weight = self.sorted_weight[keep]
+        self.weight_rank = self.weight_rank[keep]
+
+        self.step_state.BATCH_IDX = self.BATCH_IDX
+        self.step_state.POMO_IDX = self.POMO_IDX
+        self.step_state.current_node = self.step_state.current_node[keep]
+        self.step_state.accumulated_value = self.step_state.accumulated_value[keep]
+        self.step_state.capacity = self.step_state.capacity[keep]
+        self.step_state.mask = self.step_state.mask[keep]
+        self.step_state.fit_mask = self.step_state.fit_mask[keep]
+        self.step_state.finished = self.step_state.finished[keep]
+        return self.step_state
+
 
     # def old_step(self, selected):
     #     # selected.shape: (batch, pomo)
@@ -185,7 +231,7 @@ class KPEnv:
 
 def rand_pick(mask):
     batch_size, pomo_size = mask.size(0), mask.size(1)
-    prob = torch.ones_like(mask)+mask
+    prob = torch.zeros(size=mask.shape).masked_fill(mask, float('-inf'))
     prob = torch.softmax(prob,dim=-1)
     selected = prob.reshape(batch_size * pomo_size, -1).multinomial(1) \
                             .squeeze(dim=1).reshape(batch_size, pomo_size)
@@ -207,7 +253,7 @@ if __name__=="__main__":
         env.reset()
         done = False
         i =0
-        mask = env.step_state.ninf_mask
+        mask = env.step_state.mask
         while not done:
             if i == 0:
                 selected = torch.zeros(bs,pomo_s).long()
@@ -216,6 +262,6 @@ if __name__=="__main__":
             else:
                 selected = rand_pick(mask)
             state, rew, done = env.step(selected)
-            mask = state.ninf_mask
+            mask = state.mask
             i+=1
 
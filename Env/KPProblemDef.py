@@ -2,7 +2,7 @@ import torch
 import numpy as np
 
 
-def get_random_problems(batch_size, problem_size):
-    problems = torch.rand(size=(batch_size, problem_size, 2))
+def get_random_problems(batch_size, problem_size, device=None, generator=None):
+    problems = torch.rand(size=(batch_size, problem_size, 2), device=device, generator=generator)
     # problems.shape: (batch, problem, 2)
     return problems
\ No newline at end of file
@@ -26,10 +26,10 @@ class Step_OP_State:
     # shape: (batch, pomo)
     finished:torch.Tensor = None
     # shape: (batch, pomo)
-    visit_inf_mask: torch.Tensor = None
-    # shape: (batch, pomo, problem)
-    ninf_mask: torch.Tensor = None
+    visit_mask: torch.Tensor = None
     # shape: (batch, pomo, problem)
+    mask: torch.Tensor = None
+    # shape: (batch, pomo, problem), True for the nodes that can not be selected
 
 
 
@@ -50,10 +50,17 @@ class OPEnv:
         self.max_length = None
         self.current_node = None
         # shape: (batch, pomo)
-        self.selected_node_list = None
+        self.dist_matrix = None
+        # shape: (batch, problem+1, problem+1)
+        self.depot_dist = None
+        # shape: (batch, problem+1)
         self.done_idx = None
         self.length = None
         self.cur_total_prize = None
+        self.instance_idx = None
+        # shape: (batch,), index in the loaded batch of the instances still decoded, None if not compacted
+        self.total_prize_all = None
+        # shape: (loaded batch, pomo), final prizes of the dropped instances
 
     def get_length(self, scale):
         if scale<=20:
@@ -66,18 +73,23 @@ class OPEnv:
             leng = 5.
         return leng
 
-    def generate_data(self,batch_size):
-        depot, loc, prize, max_length = get_random_op_problems(batch_size, self.problem_size, self.prize_type)
-        instance = torch.zeros(loc.shape[0],loc.shape[1]+1,3)
+    def generate_data(self,batch_size, device=None, generator=None):
+        depot, loc, prize, max_length = get_random_op_problems(batch_size, self.problem_size, self.prize_type,
+                                                               device, generator)
+        instance = torch.zeros(loc.shape[0],loc.shape[1]+1,3, device=loc.device)
         instance[:,0:1,:2] = depot
         instance[:,1:,:2] = loc
         instance[:,:,2] = prize
         return instance
 
-    def load_problems(self, batch_size, aug_factor=1,prepare_dataset=None):
+    def random_problems(self, batch_size, device=None):
+        return get_random_op_problems(batch_size, self.problem_size, self.prize_type, device)
+
+    def load_problems(self, batch_size, aug_factor=1,prepare_dataset=None, generated=None):
+        # generated: the output of random_problems, e.g. prefetched, used instead of new random problems
         if prepare_dataset is None:
             self.batch_size = batch_size
-            depot, loc, prize, max_length = get_random_op_problems(batch_size, self.problem_size,self.prize_type)
+            depot, loc, prize, max_length = self.random_problems(batch_size) if generated is None else generated
         else:
             self.batch_size = prepare_dataset.shape[0]
             if prepare_dataset.shape[-1] == 3:
@@ -104,6 +116,11 @@ class OPEnv:
         self.node_xy = loc
         self.depot_node_xy = torch.cat([self.depot_xy,self.node_xy],dim=1)
         self.coords = self.depot_node_xy[:, None, :, :].expand(self.batch_size, self.pomo_size, self.problem_size+1, -1)
+        # distances between the nodes of each instance, shared by its pomo rollouts
+        self.dist_matrix = (self.depot_node_xy[:, :, None, :] - self.depot_node_xy[:, None, :, :]).norm(p=2, dim=-1)
+        # shape: (batch, problem+1, problem+1)
+        self.depot_dist = self.dist_matrix[:, 0, :]
+        # shape: (batch, problem+1)
 
         self.prize = prize[:,None,:].expand(self.batch_size, self.pomo_size, 1+self.problem_size)
         self.max_length = max_length[:,None,:].expand(self.batch_size,self.pomo_size,1).squeeze(-1)
@@ -111,21 +128,21 @@ class OPEnv:
         self.BATCH_IDX = torch.arange(self.batch_size)[:, None].expand(self.batch_size, self.pomo_size)
         self.POMO_IDX = torch.arange(self.pomo_size)[None, :].expand(self.batch_size, self.pomo_size)
 
+        self.instance_idx = None
+        self.total_prize_all = None
+
     def reset(self):
         self.current_node = None
         # shape: (batch, pomo)
         self.previous_node = None
         # shape: (batch, pomo)
 
-        self.selected_node_list = torch.zeros((self.batch_size, self.pomo_size, 0), dtype=torch.long)
-        # shape: (batch, pomo, 0~problem)
-
         # CREATE STEP STATE
         self.step_state = Step_OP_State(BATCH_IDX=self.BATCH_IDX, POMO_IDX=self.POMO_IDX)
         self.step_state.finished = torch.zeros((self.batch_size, self.pomo_size))==1
 
-        self.step_state.visit_inf_mask = torch.zeros((self.batch_size, self.pomo_size, 1+self.problem_size))
-        self.step_state.ninf_mask = torch.zeros((self.batch_size, self.pomo_size, 1+self.problem_size))
+        self.step_state.visit_mask = torch.zeros((self.batch_size, self.pomo_size, 1+self.problem_size), dtype=torch.bool)
+        self.step_state.mask = torch.zeros((self.batch_size, self.pomo_size, 1+self.problem_size), dtype=torch.bool)
         # shape: (batch, pomo, problem)
 
         reward = None
@@ -143,85 +160,90 @@ class OPEnv:
         self.step_state.selected_count += 1
 
         if self.previous_node is None:
-            pre_coord = self.depot_xy.expand(self.batch_size,self.pomo_size,-1)
+            self.length += self.depot_dist[self.BATCH_IDX, selected]
         else:
-            pre_coord = self.coords[self.BATCH_IDX, self.POMO_IDX, self.previous_node,:]
-        cur_coord = self.coords[self.BATCH_IDX, self.POMO_IDX, selected,:]
-        dist = (pre_coord - cur_coord).norm(p=2, dim=-1).squeeze(-1)
-        self.length += dist
+            self.length += self.dist_matrix[self.BATCH_IDX, self.previous_node, selected]
+        # shape: (batch, pomo)
         self.step_state.remain_dist = self.max_length - self.length
         self.current_node = selected
         self.step_state.current_node = self.current_node
-        self.selected_node_list = torch.cat((self.selected_node_list, self.current_node[:, :, None]), dim=2)
         self.previous_node = self.current_node
 
-        self.step_state.visit_inf_mask[self.BATCH_IDX, self.POMO_IDX, self.current_node] = float('-inf')
+        self.step_state.visit_mask[self.BATCH_IDX, self.POMO_IDX, self.current_node] = True
         if self.step_state.selected_count > 1:
             # if back to depot, forbid to choose any other nodes
-            idx = torch.where(self.current_node == 0)
-            self.step_state.visit_inf_mask[idx[0],idx[1],:] = float('-inf')
-        self.step_state.visit_inf_mask[:, :, 0] = 0
-        self.step_state.ninf_mask = self.step_state.visit_inf_mask.clone()
+            self.step_state.visit_mask |= (self.current_node == 0)[:, :, None]
+            self.step_state.finished = self.step_state.finished | (self.current_node == 0)
+        self.step_state.visit_mask[:, :, 0] = False
         # judge1: mask the nodes exceeding the max length if added
-        next_step_len = self.length[:, :, None] + (self.coords - cur_coord[:, :, None, :]).norm(p=2, dim=-1)
+        next_step_len = self.length[:, :, None] + self.dist_matrix[self.BATCH_IDX, selected]
+        # shape: (batch, pomo, problem+1)
         next_step_jud = (next_step_len - self.max_length[:, :, None])>0
         # judge2: mask the next nodes exceeding the max length if unable to back to the depot
-        next_step_backto_depot_len = next_step_len + (self.coords - self.depot_xy[:,None,...].expand(self.batch_size,self.pomo_size,1,-1)).norm(p=2, dim=-1)
+        next_step_backto_depot_len = next_step_len + self.depot_dist[:, None, :]
         next_step_backto_depot_jud = (next_step_backto_depot_len - self.max_length[:, :, None])>0
 
-        self.step_state.ninf_mask[torch.where((next_step_jud|next_step_backto_depot_jud)==True)] = float('-inf')
+        torch.logical_or(next_step_jud, next_step_backto_depot_jud, out=self.step_state.mask)
+        self.step_state.mask |= self.step_state.visit_mask
 
         selected_prize = self.prize[self.BATCH_IDX, self.POMO_IDX, selected]
         self.cur_total_prize += selected_prize
-        done = (self.step_state.ninf_mask[:,:,1:] == float('-inf')).all() and (selected == 0).all()
+        done = self.step_state.mask[:,:,1:].all() and (selected == 0).all()
         if done:
             # because pomo start to search at each node, so it may fail for op20 cause the max length is 2,
             # so we set the prize equal to 0 if it violates the constrain
             self.cur_total_prize[torch.where((self.length - self.max_length) > 0)] = 0
             if self.problem_size>=50:
                 assert (self.length <= self.max_length + 1e-5).all()
+            if self.instance_idx is not None:
+                self.total_prize_all[self.instance_idx] = self.cur_total_prize
+                return self.step_state, self.total_prize_all, done
         else:
-            self.step_state.ninf_mask[:, :, 0] = 0
+            self.step_state.mask[:, :, 0] = False
         return self.step_state, self.cur_total_prize, done
 
-
-    def _get_travel_distance(self,):
-        pi = self.selected_node_list
-        if pi.size(-1) == 1:  # In case all tours directly return to depot, prevent further problems
-            assert (pi == 0).all(), "If all length 1 tours, they should be zero"
-            # Return
-            return torch.zeros((pi.size(0),pi.size(1)), dtype=torch.float, device=pi.device), None
-
-        # Check that tours are valid, i.e. contain 0 to n -1
-        sorted_pi = pi.data.sort(2)[0]
-        # Make sure each node visited once at most (except for depot)
-        assert ((sorted_pi[:, :, 1:] == 0) | (sorted_pi[:, :, 1:] > sorted_pi[:,:, :-1])).all(), "Duplicates"
-        prize_with_depot = self.prize
-
-        p = prize_with_depot.gather(2, pi)
-
-        # Gather dataset in order of tour
-        loc_with_depot = self.coords
-        d = loc_with_depot.gather(2, pi[..., None].expand(*pi.size(), loc_with_depot.size(-1)))
-
-        length = (
-            (d[:,:, 1:] - d[:,:, :-1]).norm(p=2, dim=-1).sum(2)  # Prevent error if len 1 seq
-            + (d[:, :, 0] - d[:,:,0]).norm(p=2, dim=-1)  # Depot to first
-            + (d[:,:, -1] - d[:,:,0]).norm(p=2, dim=-1)  # Last to depot, will be 0 if depot is last
-        )
-        self.step_state.remain_dist = self.max_length-length
-        # assert (length <= self.max_length + 1e-5).all(), \
-        #     "Max length exceeded by {}".format((length - self.max_length).max())
-        pr = p.sum(-1)
-
-        assert torch.mean(length - self.length)<1e-4
-        assert (pr-self.cur_total_prize).mean() <1e-4
-        # We want to maximize total prize but code minimizes so return negative
-        return p.sum(-1)
+    def compact(self, keep):
+        # keep.shape: (batch,), bool, the instances to go on decoding, the others must be back at the depot
+        # drops the other instances from the rollout until the next load_problems, their prizes are kept for the
+        # reward, which is returned for the whole loaded batch at the end of the rollout
+        if self.instance_idx is None:
+            self.instance_idx = torch.arange(self.batch_size)
+            self.total_prize_all = torch.zeros((self.batch_size, self.pomo_size))
+        prize = self.cur_total_prize[~keep]
+        prize[self.length[~keep] > self.max_length[~keep]] = 0
+        self.total_prize_all[self.instance_idx[~keep]] = prize
+
+        self.instance_idx = self.instance_idx[keep]
+        self.batch_size = self.instance_idx.size(0)
+        self.BATCH_IDX = torch.arange(self.batch_size)[:, None].expand(self.batch_size, self.pomo_size)
+        self.POMO_IDX = torch.arange(self.pomo_size)[None, :].expand(self.batch_size, self.pomo_size)
+        self.depot_xy = self.depot_xy[keep]
+        self.node_xy = self.node_xy[keep]
+        self.depot_node_xy = self.depot_node_xy[keep]
+        self.coords = self.depot_node_xy[:, None, :, :].expand(self.batch_size, self.pomo_size, self.problem_size+1, -1)
+        self.dist_matrix = self.dist_matrix[keep]
+        self.depot_dist = self.dist_matrix[:, 0, :]
+        self.prize = self.prize[keep, :1].expand(self.batch_size, self.pomo_size, 1+self.problem_size)
+        # the pomo dim is an expanded one, kept as such
+        self.max_length = self.max_length[keep]
+
+        self.current_node = self.current_node[keep]
+        self.previous_node = self.previous_node[keep]
+        self.length = self.length[keep]
+        self.cur_total_prize = self.cur_total_prize[keep]
+
+        self.step_state.BATCH_IDX = self.BATCH_IDX
+        self.step_state.POMO_IDX = self.POMO_IDX
+        self.step_state.current_node = self.current_node
+        self.step_state.remain_dist = self.step_state.remain_dist[keep]
+        self.step_state.finished = self.step_state.finished[keep]
+        self.step_state.visit_mask = self.step_state.visit_mask[keep]
+        self.step_state.mask = self.step_state.mask[keep]
+        return self.step_state
 
 def rand_pick(mask):
     batch_size, pomo_size = mask.size(0), mask.size(1)
-    prob = torch.ones_like(mask)+mask
+    prob = torch.zeros(size=mask.shape).masked_fill(mask, float('-inf'))
     prob = torch.softmax(prob,dim=-1)
     selected = prob.reshape(batch_size * pomo_size, -1).multinomial(1) \
                             .squeeze(dim=1).reshape(batch_size, pomo_size)
@@ -244,7 +266,7 @@ if __name__=="__main__":
         env.reset()
         done = False
         i =0
-        mask = env.step_state.ninf_mask
+        mask = env.step_state.mask
         while not done:
             if i == 0:
                 selected = torch.zeros(bs,pomo_s).long()
@@ -253,7 +275,7 @@ if __name__=="__main__":
             else:
                 selected = rand_pick(mask)
             state, rew, done = env.step(selected)
-            mask = state.ninf_mask
+            mask = state.mask
             i+=1
 
 
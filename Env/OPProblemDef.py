@@ -1,7 +1,7 @@
 import torch
 
 
-def get_random_op_problems(batch_size, size, prize_type):
+def get_random_op_problems(batch_size, size, prize_type, device=None, generator=None):
     # Details see paper
     def get_length(scale):
         if scale<=20:
@@ -14,19 +14,20 @@ def get_random_op_problems(batch_size, size, prize_type):
             leng = 5.
         return leng
 
-    loc = torch.rand(batch_size, size, 2)
-    depot = torch.rand(batch_size,1,2)
+    loc = torch.rand(batch_size, size, 2, device=device, generator=generator)
+    depot = torch.rand(batch_size,1,2, device=device, generator=generator)
     # Methods taken from Fischetti et al. 1998
-    prize = torch.zeros(batch_size,1+size)
+    prize = torch.zeros(batch_size,1+size, device=device)
     if prize_type == 'const':
         prize[:, 1:] = 1
     elif prize_type == 'unif':
-        prize[:,1:] = (1 + torch.randint(0, 100, size=(batch_size,size, ))) / 100.
+        prize[:,1:] = (1 + torch.randint(0, 100, size=(batch_size,size, ), device=device,
+                                                  generator=generator)) / 100.
     else:  # Based on distance to depot
         assert prize_type == 'dist'
         prize_ = (depot - loc).norm(p=2, dim=-1)
         prize[:,1:] = (1 + (prize_ / prize_.max(dim=-1, keepdim=True)[0] * 99).int()).float() / 100.
-    return depot, loc, prize, torch.ones(size=(batch_size,1))*get_length(size)
+    return depot, loc, prize, torch.ones(size=(batch_size,1), device=device)*get_length(size)
 
 
 def augment_xy_data_by_8_fold(xy_data):
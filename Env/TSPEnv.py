@@ -18,8 +18,8 @@ class Step_TSP_State:
     # shape: (batch, pomo)
     current_node: torch.Tensor = None
     # shape: (batch, pomo)
-    ninf_mask: torch.Tensor = None
-    # shape: (batch, pomo, node)
+    mask: torch.Tensor = None
+    # shape: (batch, pomo, node), True for the nodes that can not be selected
 
 class TSPEnv:
     def __init__(self, **env_params):
@@ -44,16 +44,23 @@ class TSPEnv:
         self.selected_count = None
         self.current_node = None
         # shape: (batch, pomo)
-        self.selected_node_list = None
-        # shape: (batch, pomo, 0~problem)
+        self.first_xy = None
+        self.last_xy = None
+        # shape: (batch, pomo, 2)
+        self.travel_distance = None
+        # shape: (batch, pomo), from the first to the current node
 
-    def generate_data(self,batch_size):
-        return get_random_tsp_problems(batch_size, self.problem_size)
+    def generate_data(self,batch_size, device=None, generator=None):
+        return get_random_tsp_problems(batch_size, self.problem_size, device, generator)
 
-    def load_problems(self, batch_size, aug_factor=1,prepare_dataset=None):
+    def random_problems(self, batch_size, device=None):
+        return get_random_tsp_problems(batch_size, self.problem_size, device)
+
+    def load_problems(self, batch_size, aug_factor=1,prepare_dataset=None, generated=None):
+        # generated: the output of random_problems, e.g. prefetched, used instead of new random problems
         if prepare_dataset is None:
             self.batch_size = batch_size
-            self.problems = get_random_tsp_problems(batch_size, self.problem_size)
+            self.problems = self.random_problems(batch_size) if generated is None else generated
         else:
             self.batch_size = prepare_dataset.shape[0]
             self.problem_size = prepare_dataset.shape[1]
@@ -75,12 +82,14 @@ class TSPEnv:
         self.selected_count = 0
         self.current_node = None
         # shape: (batch, pomo)
-        self.selected_node_list = torch.zeros((self.batch_size, self.pomo_size, 0), dtype=torch.long)
-        # shape: (batch, pomo, 0~problem)
+        self.first_xy = None
+        self.last_xy = None
+        self.travel_distance = torch.zeros((self.batch_size, self.pomo_size))
+        # shape: (batch, pomo)
 
         # CREATE STEP STATE
         self.step_state = Step_TSP_State(BATCH_IDX=self.BATCH_IDX, POMO_IDX=self.POMO_IDX)
-        self.step_state.ninf_mask = torch.zeros((self.batch_size, self.pomo_size, self.problem_size))
+        self.step_state.mask = torch.zeros((self.batch_size, self.pomo_size, self.problem_size), dtype=torch.bool)
         # shape: (batch, pomo, problem)
 
         reward = None
@@ -98,13 +107,19 @@ class TSPEnv:
         self.selected_count += 1
         self.current_node = selected
         # shape: (batch, pomo)
-        self.selected_node_list = torch.cat((self.selected_node_list, self.current_node[:, :, None]), dim=2)
-        # shape: (batch, pomo, 0~problem)
+
+        current_xy = self.problems[self.BATCH_IDX, self.current_node]
+        # shape: (batch, pomo, 2)
+        if self.last_xy is None:
+            self.first_xy = current_xy
+        else:
+            self.travel_distance += ((current_xy - self.last_xy) ** 2).sum(2).sqrt()
+        self.last_xy = current_xy
 
         # UPDATE STEP STATE
         self.step_state.current_node = self.current_node
         # shape: (batch, pomo)
-        self.step_state.ninf_mask[self.BATCH_IDX, self.POMO_IDX, self.current_node] = float('-inf')
+        self.step_state.mask[self.BATCH_IDX, self.POMO_IDX, self.current_node] = True
         # shape: (batch, pomo, node)
 
         # returning values
@@ -117,18 +132,7 @@ class TSPEnv:
         return self.step_state, reward, done
 
     def _get_travel_distance(self):
-        gathering_index = self.selected_node_list.unsqueeze(3).expand(self.batch_size, -1, self.problem_size, 2)
-        # shape: (batch, pomo, problem, 2)
-        seq_expanded = self.problems[:, None, :, :].expand(self.batch_size, self.pomo_size, self.problem_size, 2)
-
-        ordered_seq = seq_expanded.gather(dim=2, index=gathering_index)
-        # shape: (batch, pomo, problem, 2)
-
-        rolled_seq = ordered_seq.roll(dims=2, shifts=-1)
-        segment_lengths = ((ordered_seq-rolled_seq)**2).sum(3).sqrt()
-        # shape: (batch, pomo, problem)
-
-        travel_distances = segment_lengths.sum(2)
+        # the distance accumulated in step() plus the segment back to the first node
+        travel_distances = self.travel_distance + ((self.first_xy - self.last_xy) ** 2).sum(2).sqrt()
         # shape: (batch, pomo)
         return travel_distances
-
@@ -55,7 +55,9 @@ class CVRPModel(nn.Module):
         else:
             encoded_last_node = _get_encoding(self.encoded_nodes, state.current_node)
             # shape: (batch, pomo, embedding)
-            probs = self.decoder(encoded_last_node, state.load, ninf_mask=state.ninf_mask)
+            # the env keeps a bool mask, the additive one is built for the decoder
+            ninf_mask = torch.zeros(size=state.mask.shape).masked_fill_(state.mask, float('-inf'))
+            probs = self.decoder(encoded_last_node, state.load, ninf_mask=ninf_mask)
             # shape: (batch, pomo, problem+1)
 
             if self.training or self.model_params['eval_type'] == 'softmax':
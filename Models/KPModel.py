@@ -26,7 +26,9 @@ class KPModel(nn.Module):
             # encoded_first_node = _get_encoding(self.encoded_nodes, selected)
             # self.decoder.set_q1(encoded_first_node)
         else:
-            probs = self.decoder(self.encoded_graph, state.capacity, ninf_mask=state.fit_ninf_mask)
+            # the env keeps a bool mask, the additive one is built for the decoder
+            fit_ninf_mask = torch.zeros(size=state.fit_mask.shape).masked_fill_(state.fit_mask, float('-inf'))
+            probs = self.decoder(self.encoded_graph, state.capacity, ninf_mask=fit_ninf_mask)
             if self.training or self.model_params['eval_type'] == 'softmax':
                 while True:
                     selected = probs.reshape(batch_size * pomo_size, -1).multinomial(1) \
@@ -32,7 +32,7 @@ class OPModel(nn.Module):
     def forward(self, state):
         batch_size = state.BATCH_IDX.size(0)
         pomo_size = state.BATCH_IDX.size(1)
-        problem_size = state.ninf_mask.size(-1)
+        problem_size = state.mask.size(-1)
 
         if state.selected_count == 0:  # First Move, depot
             selected = torch.zeros(size=(batch_size, pomo_size), dtype=torch.long)
@@ -55,7 +55,9 @@ class OPModel(nn.Module):
         else:
             encoded_last_node = _get_encoding(self.encoded_nodes, state.current_node)
             # shape: (batch, pomo, embedding)
-            probs = self.decoder(encoded_last_node, state.remain_dist, ninf_mask=state.ninf_mask)
+            # the env keeps a bool mask, the additive one is built for the decoder
+            ninf_mask = torch.zeros(size=state.mask.shape).masked_fill_(state.mask, float('-inf'))
+            probs = self.decoder(encoded_last_node, state.remain_dist, ninf_mask=ninf_mask)
             # shape: (batch, pomo, problem+1)
 
             if self.training or self.model_params['eval_type'] == 'softmax':
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 
 class COPModel(nn.Module):
@@ -28,9 +29,6 @@ class COPModel(nn.Module):
             out, _ = layer(out)
         # split the embedding for each decoder
         self.encoded_nodes = out.split(dims,dim=1)
-        if 'KP' in self.problem_list:
-            idx = self.problem_list.index('KP')
-            self.encoded_graph = self.encoded_nodes[idx].mean(dim=1, keepdim=True)
         for i,embed in enumerate(self.encoded_nodes):
             self.decoders[i].set_kv(embed)
 
@@ -51,7 +49,6 @@ class COPModel(nn.Module):
         elif problem == 'KP':
             for layer in self.encoder:
                 out, _ = layer(out)
-            self.encoded_graph = out.mean(dim=1, keepdim=True)
             self.encoded_nodes[idx] = out
             self.decoders[idx].set_kv(self.encoded_nodes[idx])
         elif problem == 'OP':
@@ -61,13 +58,40 @@ class COPModel(nn.Module):
             self.decoders[idx].set_kv(self.encoded_nodes[idx])
 
 
+    def pre_forward_packed(self, reset_states, problems):
+        # encode several problems (with the same batch size) in one pass of the shared encoder,
+        # each problem only attends to its own nodes and is normalized on its own, so the encodings
+        # are the same as the ones of pre_forward_oneCOP
+        header_embedding = [self.headers[self.idxs[problem]](reset_state)
+                            for reset_state, problem in zip(reset_states, problems)]
+        dims = [embed.shape[1] for embed in header_embedding]
+        out = torch.cat(header_embedding, dim=1)
+        # shape: (batch, sum of problem sizes, embedding)
+        for layer in self.encoder:
+            out, _ = layer(out, segments=dims)
+        return out.split(dims, dim=1)
+
+    def set_encoding(self, encoded_nodes, problem):
+        # make an encoding of pre_forward_packed the current one, before the rollout of its problem
+        self.encoded_nodes = [None] * len(self.problem_list)
+        idx = self.problem_list.index(problem)
+        self.encoded_nodes[idx] = encoded_nodes
+        self.decoders[idx].set_kv(encoded_nodes)
+
+    def compact(self, problem, keep):
+        # keep.shape: (batch,), bool, follows env.compact: only the kept instances are decoded from now on
+        idx = self.idxs[problem]
+        self.encoded_nodes = list(self.encoded_nodes)
+        self.encoded_nodes[idx] = self.encoded_nodes[idx][keep]
+        self.decoders[idx].compact(keep)
+
     def TSP_forward(self, state):
         batch_size = state.BATCH_IDX.size(0)
         pomo_size = state.BATCH_IDX.size(1)
 
         if state.current_node is None:
             selected = torch.arange(pomo_size)[None, :].expand(batch_size, pomo_size)
-            prob = torch.ones(size=(batch_size, pomo_size))
+            log_prob = torch.zeros(size=(batch_size, pomo_size))
 
             encoded_first_node = _get_encoding(self.encoded_nodes[self.idxs['TSP']], selected)
             # shape: (batch, pomo, embedding)
@@ -76,28 +100,17 @@ class COPModel(nn.Module):
         else:
             encoded_last_node = _get_encoding(self.encoded_nodes[self.idxs['TSP']], state.current_node)
             # shape: (batch, pomo, embedding)
-            probs = self.decoders[self.idxs['TSP']](encoded_last_node, state.ninf_mask)
+            log_probs = self.decoders[self.idxs['TSP']](encoded_last_node, state.mask)
             # shape: (batch, pomo, problem)
 
             if self.training or self.model_params['eval_type'] == 'softmax':
-                while True:
-                    selected = probs.reshape(batch_size * pomo_size, -1).multinomial(1) \
-                        .squeeze(dim=1).reshape(batch_size, pomo_size)
-                    # shape: (batch, pomo)
-
-                    prob = probs[state.BATCH_IDX, state.POMO_IDX, selected] \
-                        .reshape(batch_size, pomo_size)
-                    # shape: (batch, pomo)
-
-                    if (prob != 0).all():
-                        break
-
+                selected, log_prob = _sample(log_probs)
             else:
-                selected = probs.argmax(dim=2)
+                selected = log_probs.argmax(dim=2)
                 # shape: (batch, pomo)
-                prob = None
+                log_prob = None
 
-        return selected, prob
+        return selected, log_prob
 
     def CVRP_forward(self, state):
         batch_size = state.BATCH_IDX.size(0)
@@ -105,75 +118,54 @@ class COPModel(nn.Module):
 
         if state.selected_count == 0:  # First Move, depot
             selected = torch.zeros(size=(batch_size, pomo_size), dtype=torch.long)
-            prob = torch.ones(size=(batch_size, pomo_size))
+            log_prob = torch.zeros(size=(batch_size, pomo_size))
 
         elif state.selected_count == 1:  # Second Move, POMO
             selected = torch.arange(start=1, end=pomo_size + 1)[None, :].expand(batch_size, pomo_size)
-            prob = torch.ones(size=(batch_size, pomo_size))
+            log_prob = torch.zeros(size=(batch_size, pomo_size))
 
         else:
             encoded_last_node = _get_encoding(self.encoded_nodes[self.idxs['CVRP']], state.current_node)
             # shape: (batch, pomo, embedding)
-            probs = self.decoders[self.idxs['CVRP']](encoded_last_node, state.load, state.ninf_mask)
+            log_probs = self.decoders[self.idxs['CVRP']](encoded_last_node, state.load, state.mask)
             # shape: (batch, pomo, problem+1)
 
             if self.training or self.model_params['eval_type'] == 'softmax':
-                while True:  # to fix pytorch.multinomial bug on selecting 0 probability elements
-                    with torch.no_grad():
-                        selected = probs.reshape(batch_size * pomo_size, -1).multinomial(1) \
-                            .squeeze(dim=1).reshape(batch_size, pomo_size)
-                    # shape: (batch, pomo)
-                    prob = probs[state.BATCH_IDX, state.POMO_IDX, selected].reshape(batch_size, pomo_size)
-                    # shape: (batch, pomo)
-                    if (prob != 0).all():
-                        break
-
+                selected, log_prob = _sample(log_probs)
             else:
-                selected = probs.argmax(dim=2)
+                selected = log_probs.argmax(dim=2)
                 # shape: (batch, pomo)
-                prob = None  # value not needed. Can be anything.
+                log_prob = None  # value not needed. Can be anything.
 
-        return selected, prob
+        return selected, log_prob
 
     def KP_forward(self, state):
         batch_size = state.BATCH_IDX.size(0)
         pomo_size = state.BATCH_IDX.size(1)
         if state.current_node is None:
             selected = torch.arange(pomo_size)[None, :].expand(batch_size, pomo_size)
-            prob = torch.ones(size=(batch_size, pomo_size))
+            log_prob = torch.zeros(size=(batch_size, pomo_size))
             # encoded_first_node = _get_encoding(self.encoded_nodes, selected)
             # self.decoder.set_q1(encoded_first_node)
         else:
-            probs = self.decoders[self.idxs['KP']](self.encoded_graph, state.capacity, state.fit_ninf_mask)
+            log_probs = self.decoders[self.idxs['KP']](state.capacity, state.fit_mask)
             if self.training or self.model_params['eval_type'] == 'softmax':
-                while True:
-                    selected = probs.reshape(batch_size * pomo_size, -1).multinomial(1) \
-                        .squeeze(dim=1).reshape(batch_size, pomo_size)
-                    # shape: (batch, pomo)
-
-                    prob = probs[state.BATCH_IDX, state.POMO_IDX, selected] \
-                        .reshape(batch_size, pomo_size)
-                    # prob = prob*(~state.finished)+state.finished
-                    # shape: (batch, pomo)
-
-                    if (prob != 0).all():
-                        break
-
+                selected, log_prob = _sample(log_probs)
+                # log_prob = log_prob*(~state.finished)
             else:
-                selected = probs.argmax(dim=2)
+                selected = log_probs.argmax(dim=2)
                 # shape: (batch, pomo)
-                prob = None
+                log_prob = None
 
-        return selected, prob
+        return selected, log_prob
 
     def OP_forward(self, state):
         batch_size = state.BATCH_IDX.size(0)
         pomo_size = state.BATCH_IDX.size(1)
-        problem_size = state.ninf_mask.size(-1)
 
         if state.selected_count == 0:  # First Move, depot
             selected = torch.zeros(size=(batch_size, pomo_size), dtype=torch.long)
-            probs = torch.ones(size=(batch_size, pomo_size, problem_size))
+            log_prob = torch.zeros(size=(batch_size, pomo_size))
 
             # # Use Averaged encoded nodes for decoder input_1
             # encoded_nodes_mean = self.encoded_nodes.mean(dim=1, keepdim=True)
@@ -187,44 +179,100 @@ class COPModel(nn.Module):
 
         elif state.selected_count == 1:  # Second Move, POMO
             selected = torch.arange(start=1, end=pomo_size+1)[None, :].expand(batch_size, pomo_size)
-            probs = torch.ones(size=(batch_size, pomo_size,problem_size))
+            log_prob = torch.zeros(size=(batch_size, pomo_size))
 
         else:
             encoded_last_node = _get_encoding(self.encoded_nodes[self.idxs['OP']], state.current_node)
             # shape: (batch, pomo, embedding)
-            probs = self.decoders[self.idxs['OP']](encoded_last_node, state.remain_dist, state.ninf_mask)
+            log_probs = self.decoders[self.idxs['OP']](encoded_last_node, state.remain_dist, state.mask)
             # shape: (batch, pomo, problem+1)
 
             if self.training or self.model_params['eval_type'] == 'softmax':
-                while True:  # to fix pytorch.multinomial bug on selecting 0 probability elements
-                    with torch.no_grad():
-                        selected = probs.reshape(batch_size * pomo_size, -1).multinomial(1) \
-                            .squeeze(dim=1).reshape(batch_size, pomo_size)
-                    # shape: (batch, pomo)
-                    prob = probs[state.BATCH_IDX, state.POMO_IDX, selected].reshape(batch_size, pomo_size)
-                    # shape: (batch, pomo)
-                    if (prob != 0).all():
-                        break
-
+                selected, log_prob = _sample(log_probs)
             else:
-                selected = probs.argmax(dim=2)
+                selected = log_probs.argmax(dim=2)
                 # shape: (batch, pomo)
-                probs = None  # value not needed. Can be anything.
+                log_prob = None  # value not needed. Can be anything.
 
-        return selected, probs
+        return selected, log_prob
 
-    def forward(self, state, problem):
+    def decoder_inputs(self, state, problem):
+        # what the decoder is fed at this step: (last node, load/remain_dist/capacity, bit-packed mask),
+        # None at the steps whose node is fixed (first moves)
         if problem == 'TSP':
-            selected, prob = self.TSP_forward(state)
+            if state.current_node is None:
+                return None
+            return state.current_node, None, pack_mask(state.mask)
         elif problem == 'CVRP':
-            selected, prob = self.CVRP_forward(state)
+            if state.selected_count < 2:
+                return None
+            return state.current_node, state.load.clone(), pack_mask(state.mask)
         elif problem == 'KP':
-            selected, prob = self.KP_forward(state)
+            if state.current_node is None:
+                return None
+            return None, state.capacity.clone(), pack_mask(state.fit_mask)
         elif problem == 'OP':
-            selected, prob = self.OP_forward(state)
+            if state.selected_count < 2:
+                return None
+            return state.current_node, state.remain_dist.clone(), pack_mask(state.mask)
         else:
             NotImplementedError
-        return selected, prob
+
+    def teacher_forced_log_prob(self, problem, nodes, features, masks, selected, pomo_size, chunk_steps=None,
+                                use_checkpoint=False):
+        # log-probabilities of given actions, with all decoding steps folded into the pomo dim
+        # nodes, features, selected.shape: (batch, steps*pomo)
+        # masks.shape: (batch, steps*pomo, ceil(problem/8)), bit-packed by pack_mask
+        idx = self.idxs[problem]
+        decoder = self.decoders[idx]
+        encoded_nodes = self.encoded_nodes[idx]
+        batch_size = masks.size(0)
+        num_steps = masks.size(1) // pomo_size
+        chunk_steps = num_steps if chunk_steps is None else chunk_steps
+
+        def chunk_log_prob(start, end):
+            part = slice(start * pomo_size, end * pomo_size)
+            mask = unpack_mask(masks[:, part], encoded_nodes.size(1))
+            # shape: (batch, chunk*pomo, problem)
+            if problem == 'TSP':
+                first_node = torch.arange(pomo_size)[None, :].expand(batch_size, pomo_size)
+                decoder.set_q1(_get_encoding(encoded_nodes, first_node))
+                decoder.q_first = decoder.q_first.repeat(1, 1, end - start, 1)
+                log_probs = decoder(_get_encoding(encoded_nodes, nodes[:, part]), mask)
+            elif problem == 'KP':
+                log_probs = decoder(features[:, part], mask)
+            else:
+                log_probs = decoder(_get_encoding(encoded_nodes, nodes[:, part]), features[:, part], mask)
+            # shape: (batch, chunk*pomo, problem)
+            log_prob = log_probs.gather(dim=2, index=selected[:, part, None]).squeeze(dim=2)
+            return log_prob.reshape(batch_size, end - start, pomo_size).sum(dim=1)
+
+        log_prob = torch.zeros(size=(batch_size, pomo_size))
+        # shape: (batch, pomo)
+        for start in range(0, num_steps, chunk_steps):
+            end = min(start + chunk_steps, num_steps)
+            if use_checkpoint:
+                log_prob = log_prob + checkpoint(chunk_log_prob, start, end, use_reentrant=False)
+            else:
+                log_prob = log_prob + chunk_log_prob(start, end)
+        return log_prob
+
+    def forward(self, state, problem, teacher_forcing=None):
+        # returns the selected nodes and their log-probabilities, None when decoding greedily
+        # with teacher_forcing (the arguments of teacher_forced_log_prob), returns the summed log-probabilities
+        if teacher_forcing is not None:
+            return self.teacher_forced_log_prob(problem, **teacher_forcing)
+        if problem == 'TSP':
+            selected, log_prob = self.TSP_forward(state)
+        elif problem == 'CVRP':
+            selected, log_prob = self.CVRP_forward(state)
+        elif problem == 'KP':
+            selected, log_prob = self.KP_forward(state)
+        elif problem == 'OP':
+            selected, log_prob = self.OP_forward(state)
+        else:
+            NotImplementedError
+        return selected, log_prob
 
     def get_atten_weights(self, reset_states):
         header_embedding = []
@@ -235,11 +283,40 @@ class COPModel(nn.Module):
         out = torch.cat(header_embedding, dim=1)
         weights = []
         for layer in self.encoder:
-            out, layer_weight = layer(out)
+            out, layer_weight = layer(out, need_weights=True)
             weights.append(layer_weight)
         return torch.stack(weights, dim=1) # B x L x H x N x N
 
 
+def _sample(log_probs):
+    # log_probs.shape: (batch, pomo, problem)
+    # Gumbel-max: argmax(log_probs - log(E)), E ~ Exp(1), draws from softmax(log_probs) in one pass,
+    # the masked nodes have -inf log-probabilities and are never selected
+    with torch.no_grad():
+        noise = torch.empty_like(log_probs).exponential_().clamp_(min=torch.finfo(log_probs.dtype).tiny).log_()
+        selected = (log_probs - noise).argmax(dim=2)
+    # shape: (batch, pomo)
+    log_prob = log_probs.gather(dim=2, index=selected[:, :, None]).squeeze(dim=2)
+    # shape: (batch, pomo)
+    return selected, log_prob
+
+
+def pack_mask(mask):
+    # mask.shape: (..., problem), bool
+    # 8 nodes per byte, shape: (..., ceil(problem/8)), uint8
+    pad = -mask.size(-1) % 8
+    if pad:
+        mask = torch.cat((mask, torch.zeros(size=(*mask.shape[:-1], pad), dtype=torch.bool)), dim=-1)
+    bits = mask.reshape(*mask.shape[:-1], -1, 8).to(torch.uint8)
+    return (bits << torch.arange(8, dtype=torch.uint8)).sum(dim=-1, dtype=torch.uint8)
+
+
+def unpack_mask(packed, problem_size):
+    # inverse of pack_mask, shape: (..., problem)
+    bits = (packed[..., None] >> torch.arange(8, dtype=torch.uint8)) & 1
+    return bits.reshape(*packed.shape[:-1], -1)[..., :problem_size].bool()
+
+
 def _get_encoding(encoded_nodes, node_index_to_pick):
     # encoded_nodes.shape: (batch, problem, embedding)
     # node_index_to_pick.shape: (batch, pomo)
@@ -305,12 +382,18 @@ class Add_And_Normalization_Module(nn.Module):
         embedding_dim = model_params['embedding_dim']
         self.norm = nn.InstanceNorm1d(embedding_dim, affine=True, track_running_stats=False)
 
-    def forward(self, input1, input2):
+    def forward(self, input1, input2, segments=None):
         # input.shape: (batch, problem, embedding)
+        # segments: sizes of packed problems along the problem dim, each one is normalized on its own
 
         added = input1 + input2
         # shape: (batch, problem, embedding)
 
+        if segments is not None:
+            return torch.cat([self.normalize(part) for part in added.split(segments, dim=1)], dim=1)
+        return self.normalize(added)
+
+    def normalize(self, added):
         transposed = added.transpose(1, 2)
         # shape: (batch, embedding, problem)
 
@@ -375,10 +458,10 @@ def multi_head_attention(q, k, v, rank2_ninf_mask=None, rank3_ninf_mask=None):
     if rank3_ninf_mask is not None:
         score_scaled = score_scaled + rank3_ninf_mask[:, None, :, :].expand(batch_s, head_num, n, input_s)
 
-    weights = nn.Softmax(dim=3)(score_scaled)
-    # shape: (batch, head_num, n, problem)
+    weights = nn.Softmax(dim=3)(score_scaled.float())
+    # shape: (batch, head_num, n, problem), the softmax stays in fp32 under autocast
 
-    out = torch.matmul(weights, v)
+    out = torch.matmul(weights.to(v.dtype), v)
     # shape: (batch, head_num, n, key_dim)
 
     out_transposed = out.transpose(1, 2)
@@ -390,6 +473,37 @@ def multi_head_attention(q, k, v, rank2_ninf_mask=None, rank3_ninf_mask=None):
     return out_concat, weights
 
 
+def attention(q, k, v, keep=None, reference=False):
+    # q shape: (batch, head_num, n, key_dim)
+    # k,v shape: (batch, head_num, problem, key_dim)
+    # keep.shape: (batch, n, problem), bool, True where the node can be attended to
+    # fused scaled_dot_product_attention, the attention weights are not materialized and None is returned for them,
+    # reference: multi_head_attention, which also returns the weights
+    if reference:
+        ninf_mask = None if keep is None else torch.zeros(size=keep.shape).masked_fill_(~keep, float('-inf'))
+        return multi_head_attention(q, k, v, rank3_ninf_mask=ninf_mask)
+
+    batch_s, head_num, n, key_dim = q.shape
+    attn_mask = None if keep is None else keep[:, None, :, :]
+    # shape: (batch, 1, n, problem), broadcast over the heads, a bool attn_mask is True where attention is allowed
+    out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+    # shape: (batch, head_num, n, key_dim)
+
+    out_concat = out.transpose(1, 2).reshape(batch_s, n, head_num * key_dim)
+    # shape: (batch, n, head_num*key_dim)
+
+    return out_concat, None
+
+
+def _fuse_legacy_weights(fused, names):
+    # load_state_dict pre-hook, concatenates the weights of checkpoints saved with separate projections
+    def hook(state_dict, prefix, *args):
+        keys = [prefix + name + '.weight' for name in names]
+        if all(key in state_dict for key in keys):
+            state_dict[prefix + fused + '.weight'] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+    return hook
+
+
 class Encoder(nn.Module):
     def __init__(self, **model_params):
         super().__init__()
@@ -398,33 +512,44 @@ class Encoder(nn.Module):
         head_num = self.model_params['head_num']
         qkv_dim = self.model_params['qkv_dim']
 
-        self.Wq = nn.Linear(embedding_dim, head_num * qkv_dim, bias=False)
-        self.Wk = nn.Linear(embedding_dim, head_num * qkv_dim, bias=False)
-        self.Wv = nn.Linear(embedding_dim, head_num * qkv_dim, bias=False)
+        self.Wqkv = nn.Linear(embedding_dim, 3 * head_num * qkv_dim, bias=False)
         self.multi_head_combine = nn.Linear(head_num * qkv_dim, embedding_dim)
+        self._register_load_state_dict_pre_hook(_fuse_legacy_weights('Wqkv', ['Wq', 'Wk', 'Wv']))
+        self.reference_attention = self.model_params.get('attention', 'sdpa') == 'reference'
 
         self.addAndNormalization1 = Add_And_Normalization_Module(**model_params)
         self.feedForward = Feed_Forward_Module(**model_params)
         self.addAndNormalization2 = Add_And_Normalization_Module(**model_params)
 
-    def forward(self, input1):
+    def forward(self, input1, segments=None, need_weights=False):
         # input.shape: (batch, problem, EMBEDDING_DIM)
+        # segments: sizes of packed problems along the problem dim, each one only attends to its own nodes
         head_num = self.model_params['head_num']
 
-        q = reshape_by_heads(self.Wq(input1), head_num=head_num)
-        k = reshape_by_heads(self.Wk(input1), head_num=head_num)
-        v = reshape_by_heads(self.Wv(input1), head_num=head_num)
+        q, k, v = self.Wqkv(input1).chunk(3, dim=2)
+        q = reshape_by_heads(q, head_num=head_num)
+        k = reshape_by_heads(k, head_num=head_num)
+        v = reshape_by_heads(v, head_num=head_num)
         # q shape: (batch, HEAD_NUM, problem, KEY_DIM)
 
-        out_concat, weights = multi_head_attention(q, k, v)
+        reference = self.reference_attention or need_weights
+        if segments is None:
+            out_concat, weights = attention(q, k, v, reference=reference)
+        else:
+            # one attention call per problem, the projections above and the layers below still run on the packed
+            # nodes at once
+            out_concat = torch.cat([attention(q_part, k_part, v_part, reference=reference)[0] for q_part, k_part, v_part
+                                    in zip(q.split(segments, dim=2), k.split(segments, dim=2), v.split(segments, dim=2))],
+                                   dim=1)
+            weights = None
         # shape: (batch, problem, HEAD_NUM*KEY_DIM)
 
         multi_head_out = self.multi_head_combine(out_concat)
         # shape: (batch, problem, EMBEDDING_DIM)
 
-        out1 = self.addAndNormalization1(input1, multi_head_out)
+        out1 = self.addAndNormalization1(input1, multi_head_out, segments)
         out2 = self.feedForward(out1)
-        out3 = self.addAndNormalization2(out1, out2)
+        out3 = self.addAndNormalization2(out1, out2, segments)
 
         return out3, weights
 
@@ -446,19 +571,24 @@ class Decoder(nn.Module):
             self.q_first = None  # saved q1, for multi-head attention
         elif problem == 'KP':
             self.Wq = nn.Linear(1 + embedding_dim, head_num * qkv_dim, bias=False)
+            self.q_graph = None  # graph part of the query, fixed during the rollout
+            self.q_capacity = None  # capacity column of Wq
         elif problem == 'OP':
             self.Wq_last = nn.Linear(embedding_dim + 1, head_num * qkv_dim, bias=False)
             self.q_first = None
         else:
             NotImplementedError
-        self.Wk = nn.Linear(embedding_dim, head_num * qkv_dim, bias=False)
-        self.Wv = nn.Linear(embedding_dim, head_num * qkv_dim, bias=False)
+        self.Wkv = nn.Linear(embedding_dim, 2 * head_num * qkv_dim, bias=False)
+        self._register_load_state_dict_pre_hook(_fuse_legacy_weights('Wkv', ['Wk', 'Wv']))
+        self.reference_attention = self.model_params.get('attention', 'sdpa') == 'reference'
 
         self.multi_head_combine = nn.Linear(head_num * qkv_dim, embedding_dim)
 
         self.k = None  # saved key, for multi-head attention
         self.v = None  # saved value, for multi-head_attention
         self.single_head_key = None  # saved, for single-head attention
+        self.fused_key = None  # multi_head_combine folded into single_head_key
+        self.fused_bias = None
         self.embedding_dim = embedding_dim
         self.head_num = head_num
 
@@ -466,11 +596,37 @@ class Decoder(nn.Module):
         # encoded_nodes.shape: (batch, problem, embedding)
         head_num = self.model_params['head_num']
 
-        self.k = reshape_by_heads(self.Wk(encoded_nodes), head_num=head_num)
-        self.v = reshape_by_heads(self.Wv(encoded_nodes), head_num=head_num)
+        k, v = self.Wkv(encoded_nodes).chunk(2, dim=2)
+        self.k = reshape_by_heads(k, head_num=head_num)
+        self.v = reshape_by_heads(v, head_num=head_num)
         # shape: (batch, head_num, pomo, qkv_dim)
         self.single_head_key = encoded_nodes.transpose(1, 2)
         # shape: (batch, embedding, problem)
+        # the combine and the single-head key are fixed during the rollout, so (x W^T + b) K = x (W^T K) + b K
+        self.fused_key = torch.matmul(self.multi_head_combine.weight.t(), self.single_head_key)
+        # shape: (batch, head_num*qkv_dim, problem)
+        self.fused_bias = torch.matmul(self.multi_head_combine.bias, self.single_head_key)[:, None, :]
+        # shape: (batch, 1, problem)
+        if self.problem == 'KP':
+            # Wq [graph, capacity] = Wq[:, :embedding] graph + Wq[:, embedding] capacity, only the capacity changes
+            encoded_graph = encoded_nodes.mean(dim=1, keepdim=True)
+            # shape: (batch, 1, embedding)
+            self.q_graph = F.linear(encoded_graph, self.Wq.weight[:, :self.embedding_dim])
+            # shape: (batch, 1, head_num*qkv_dim)
+            self.q_capacity = self.Wq.weight[:, self.embedding_dim].to(self.q_graph.dtype)
+            # shape: (head_num*qkv_dim,)
+
+    def compact(self, keep):
+        # keep.shape: (batch,), bool, drops the other instances from the saved keys and queries
+        self.k = self.k[keep]
+        self.v = self.v[keep]
+        self.single_head_key = self.single_head_key[keep]
+        self.fused_key = self.fused_key[keep]
+        self.fused_bias = self.fused_bias[keep]
+        if self.problem == 'KP':
+            self.q_graph = self.q_graph[keep]
+        elif getattr(self, 'q_first', None) is not None:
+            self.q_first = self.q_first[keep]
 
     def set_q1(self, encoded_q1):
         # encoded_q.shape: (batch, n, embedding)  # n can be 1 or pomo
@@ -485,15 +641,15 @@ class Decoder(nn.Module):
 
     def forward(self, *input):
         # encoded_last_node.shape: (batch, pomo, embedding)
-        # ninf_mask.shape: (batch, pomo, problem)
+        # mask.shape: (batch, pomo, problem), bool, True for the nodes that can not be selected
         head_num = self.model_params['head_num']
 
         if self.problem =='TSP':
-            encoded_last_node, ninf_mask = input
+            encoded_last_node, mask = input
             q_last = reshape_by_heads(self.Wq_last(encoded_last_node), head_num=head_num)
             q = self.q_first + q_last
         elif self.problem == 'CVRP':
-            encoded_last_node, load, ninf_mask = input
+            encoded_last_node, load, mask = input
             input_cat = torch.cat((encoded_last_node, load[:, :, None]), dim=2)
             # shape = (batch, group, EMBEDDING_DIM+1)
 
@@ -503,35 +659,32 @@ class Decoder(nn.Module):
             # # shape: (batch, head_num, pomo, qkv_dim)
             q = q_last
         elif self.problem == 'KP':
-            graph, capacity, ninf_mask = input
-            batch_s = capacity.size(0)
-            group_s = capacity.size(1)
+            capacity, mask = input
+            # capacity.shape: (batch, group)
 
             #  Multi-Head Attention
             #######################################################
-            input1 = graph.expand(batch_s, group_s, self.embedding_dim)
-            input2 = capacity[:, :, None]
-            input_cat = torch.cat((input1, input2), dim=2)
-            # shape = (batch, group, 1+EMBEDDING_DIM)
-            q = reshape_by_heads(self.Wq(input_cat), head_num=self.head_num)
+            q = self.q_graph + capacity[:, :, None].to(self.q_capacity.dtype) * self.q_capacity
+            # shape = (batch, group, head_num*qkv_dim)
+            q = reshape_by_heads(q, head_num=self.head_num)
         elif self.problem == 'OP':
-            encoded_last_node, remain_dist, ninf_mask = input
+            encoded_last_node, remain_dist, mask = input
             input_cat = torch.cat((encoded_last_node, remain_dist[:, :, None]), dim=2)
             q_last = reshape_by_heads(self.Wq_last(input_cat), head_num=head_num)
             q = q_last
         else:
             NotImplementedError
 
-        out_concat, _ = multi_head_attention(q, self.k, self.v, rank3_ninf_mask=ninf_mask)
+        # the env keeps bool masks and updates them in place, keep is a new tensor for the backward
+        keep = None if mask is None else ~mask
+        # shape: (batch, pomo, problem)
+        out_concat, _ = attention(q, self.k, self.v, keep=keep, reference=self.reference_attention)
         # shape: (batch, pomo, head_num*qkv_dim)
 
-        mh_atten_out = self.multi_head_combine(out_concat)
-        # shape: (batch, pomo, embedding)
-
         #  Single-Head Attention, for probability calculation
         #######################################################
-        score = torch.matmul(mh_atten_out, self.single_head_key)
-        # shape: (batch, pomo, problem)
+        score = (torch.matmul(out_concat, self.fused_key) + self.fused_bias).float()
+        # shape: (batch, pomo, problem), logit clipping and the softmax stay in fp32 under autocast
 
         sqrt_embedding_dim = self.model_params['sqrt_embedding_dim']
         logit_clipping = self.model_params['logit_clipping']
@@ -540,13 +693,13 @@ class Decoder(nn.Module):
         # shape: (batch, pomo, problem)
 
         score_clipped = logit_clipping * torch.tanh(score_scaled)
-        if ninf_mask is None:
+        if keep is None:
             score_masked = score_clipped
         else:
-            score_masked = score_clipped + ninf_mask
-        probs = F.softmax(score_masked, dim=2)
+            score_masked = torch.where(keep, score_clipped, float('-inf'))
+        log_probs = F.log_softmax(score_masked, dim=2)
         # shape: (batch, pomo, problem)
 
-        return probs
+        return log_probs
 
 
@@ -1,6 +1,7 @@
 from logging import getLogger
 from Env.COPEnv import COPEnv as Env
 from Models.models import COPModel as Model
+from rollout import rollout
 from utils import *
 import pickle
 
@@ -64,7 +65,7 @@ class COPTester:
             for scale in scales:
                 with open('./datasets/{}/validation/{}-{}-10000.pkl'.format(problem, problem, scale), 'rb') as f:
                     data_gt = pickle.load(f)
-                    self.test_data[-1].append(data_gt['data'].float().cuda())
+                    self.test_data[-1].append(data_gt['data'].float())
                     self.gt[-1].append(data_gt['gt'])
 
         # result folder, logger
@@ -83,6 +84,8 @@ class COPTester:
             torch.set_default_tensor_type('torch.FloatTensor')
         self.device = device
 
+        self.test_data = [[data.to(device) for data in cop_data] for cop_data in self.test_data]
+
         # ENV and MODEL
         self.env_list = Env(**self.test_env_params).env_list
         self.model = Model(self.problem,**self.model_params)
@@ -217,10 +220,8 @@ class COPTester:
                     env = cop_env[i]
                     state, reward, done = states[k][i], rewards[k][i], dones[k][i]
                     self.model.pre_forward_oneCOP(reset_state[k][i], problem)
-                    while not done:
-                        selected, _ = self.model(state, problem)
-                        # shape: (batch, pomo)
-                        state, reward, done = env.step(selected)
+                    reward, _ = rollout(self.model, env, problem, state, reward, done,
+                                        self.tester_params.get('compact'))
 
 
                     # Return
@@ -228,7 +229,7 @@ class COPTester:
                     if problem == 'KP':
                         aug_factor = 1
 
-                    aug_reward = reward.reshape(aug_factor, env.batch_size//aug_factor, env.pomo_size)
+                    aug_reward = reward.reshape(aug_factor, reward.size(0)//aug_factor, env.pomo_size)
                     # shape: (augmentation, batch, pomo)
 
                     max_pomo_reward, _ = aug_reward.max(dim=2)  # get best results from pomo
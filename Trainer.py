@@ -5,7 +5,11 @@ from Models.models import COPModel as Model
 from torch.optim import Adam as Optimizer
 from torch.optim.lr_scheduler import MultiStepLR as Scheduler
 from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
 from utils import *
+from rollout import rollout, two_phase_rollout
+from prefetcher import InstancePrefetcher
+from influence import GradientStore, SimilarityAccumulator, GradientShard, GradientSketcher
 from SMPyBandits.SMPyBandits.Policies.Exp3R import Exp3R
 from SMPyBandits.SMPyBandits.Policies.Exp3 import Exp3
 from SMPyBandits.SMPyBandits.Policies.Thompson import Thompson
@@ -15,7 +19,10 @@ import pickle
 import torch.distributed as dist
 from copy import deepcopy
 import time
+import threading
+import contextlib
 import itertools
+import zlib
 
 
 def get_all_permutations(n):
@@ -78,6 +85,13 @@ class Trainer:
         else:
             device = torch.device('cpu')
             torch.set_default_tensor_type('torch.FloatTensor')
+        self.device = device
+
+        # mixed precision, fp16 needs the loss scaling, bf16 does not
+        if opts.amp == 'fp16' and not USE_CUDA:
+            raise ValueError('--amp fp16 needs cuda, use --amp bf16 on cpu')
+        self.amp_dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}.get(opts.amp)
+        self.scaler = torch.cuda.amp.GradScaler(enabled=opts.amp == 'fp16')
 
         # Main Components
         self.problem = list(self.env_params.keys())
@@ -95,13 +109,33 @@ class Trainer:
 
         # bandit setting
         nbArms = sum([len(cop_env) for cop_env in self.env_list])
+        self.arm_cop = [i for i, cop_env in enumerate(self.env_list) for _ in cop_env]
 
         self.select_freq = nbArms if opts.select_freq is None else opts.select_freq
-
-        if self.trainer_params['train_episodes'] % self.trainer_params['train_batch_size'] == 0:
-            num_batch = self.trainer_params['train_episodes'] // self.trainer_params['train_batch_size']
+        self.pack = min(opts.pack, nbArms)
+        # micro-batch size per (problem, scale): the table micro_batch of config.yaml, overridden by the task sizes of
+        # --micro_batch, e.g. CVRP100:128. with --micro_batch auto the other arms are probed (see _probe_micro_batch),
+        # else they use the size of --micro_batch without a task, the key None
+        self.micro_batch_size = {}
+        for problem, sizes in (self.trainer_params.get('micro_batch') or {}).items():
+            for problem_size, size in sizes.items():
+                self.micro_batch_size[(problem, int(problem_size))] = int(size)
+        self.probe_micro_batch = False
+        for item in opts.micro_batch or []:
+            if item == 'auto':
+                self.probe_micro_batch = USE_CUDA
+                continue
+            task, _, size = item.rpartition(':')
+            problem = task.rstrip('0123456789')
+            self.micro_batch_size[(problem, int(task[len(problem):])) if task else None] = int(size)
+
+        # a step trains each of its self.pack arms on train_batch_size episodes
+        step_episodes = self.trainer_params['train_batch_size'] * self.pack
+        self.epoch_steps = self.trainer_params['train_episodes'] // step_episodes
+        if self.trainer_params['train_episodes'] % step_episodes == 0:
+            num_batch = self.trainer_params['train_episodes'] // step_episodes
         else:
-            num_batch = self.trainer_params['train_episodes'] // self.trainer_params['train_batch_size'] + 1
+            num_batch = self.trainer_params['train_episodes'] // step_episodes + 1
         horizon = (num_batch * self.trainer_params['epochs'])//self.select_freq if (num_batch * self.trainer_params['epochs'])\
                                                                                    %self.select_freq ==0 else (num_batch * self.trainer_params['epochs'])//self.select_freq+1
         if self.bandit_alg == 'exp3':
@@ -117,35 +151,29 @@ class Trainer:
             self.bandit = Exp3(nbArms) # just for taking place, no use
         
         self.bandit.startGame()
-        self.gradient_info = {i:{} for i in range(nbArms)}
+        gradient_state = None
+        gradient_layout = None
         self.gradient_norm = [[] for i in range(nbArms)]
         self.loss_each_task = [[] for i in range(nbArms)]
 
         self.choices = []
+        self.choice_schedule = []
+        self.prefetched_until = 0  # the instances of the scheduled steps before this one (total_count) are queued
+        self.epoch_episode = 0  # episodes of the epoch before the current step
         self.influ_mats_sim = []
         self.influ_mats_sim_share = []
         self.influ_mats_sim_header = []
         self.influ_mats_sim_dec = []
 
         self.rewards = []
+        self.sketch_errors = []
         self.eval_res = []
         self.training_time = []
         self.training_time_light = []
 
-        if self.rank == 0:
-            self.overall_seen_data = []
-            for i, cop_env in enumerate(self.env_list):
-                self.overall_seen_data.append([])
-                for j, env in enumerate(cop_env):
-                    generate_data = env.generate_data(opts.evaluation_size * dist.get_world_size()).cpu()
-                    self.overall_seen_data[-1].append(generate_data)
-
-            self.overall_unseen_data = []
-            for i,cop_env in enumerate(self.unseen_env_list):
-                self.overall_unseen_data.append([])
-                for j,env in enumerate(cop_env):
-                    generate_data = env.generate_data(opts.evaluation_size*dist.get_world_size()).cpu()
-                    self.overall_unseen_data[-1].append(generate_data)
+        # seed of the validation data, see _validation_shard
+        self.val_seed = opts.val_seed
+        saved_validation_data = None
 
         # Restore
         model_load = trainer_params['model_load']
@@ -173,7 +201,11 @@ class Trainer:
                 self.result_log.set_raw_data(checkpoint['result_log'])
 
             self.start_epoch = 1 + checkpoint['epoch']
-            self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+            try:
+                self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+            except ValueError:
+                # checkpoints with separate attention projections, their optimizer moments do not map onto the fused ones
+                self.logger.info('Optimizer state does not match the model parameters, starting from a fresh one')
             self.scheduler.last_epoch = checkpoint['epoch'] - 1
             # load resume info for bandit algorithm
             with open('{}/bandit_info-{}.pkl'.format(model_load['path'],load_epoch), 'rb') as file:
@@ -193,66 +225,96 @@ class Trainer:
 
             self.select_freq = checkpoint['select_freq']
             self.total_count = checkpoint['total_count']
-            self.overall_seen_data = checkpoint['overall_seen_data']
-            self.overall_unseen_data = checkpoint['overall_unseen_data']
+            self.val_seed = checkpoint.get('val_seed', self.val_seed)
+            if 'overall_seen_data' in checkpoint:
+                # checkpoints that kept the validation data of all the ranks
+                saved_validation_data = [checkpoint['overall_seen_data'], checkpoint['overall_unseen_data']]
 
             self.gradient_norm = checkpoint['gradient_norm']
             self.loss_each_task = checkpoint['loss_each_task']
 
-            self.gradient_info = checkpoint['gradient_info']
+            gradient_state = checkpoint['gradient_store'] if 'gradient_store' in checkpoint else checkpoint['gradient_info']
+            gradient_layout = checkpoint.get('gradient_layout', {'sketch_dim': None})
             
             self.training_time = checkpoint['training_time']
             self.training_time_light = checkpoint['training_time_light']
+        # gradients of the current selection window, every rank records its slice of the (all-reduced) gradients
+        grad_dims = dict(share_dim=sum(p.numel() for p in self.model.encoder.parameters()),
+                         head_dims=[sum(p.numel() for p in header.parameters()) for header in self.model.headers],
+                         dec_dims=[sum(p.numel() for p in decoder.parameters()) for decoder in self.model.decoders])
+        self.grad_shard = None
+        if dist.get_world_size() > 1:
+            self.grad_shard = GradientShard(rank=rank, world_size=dist.get_world_size(), **grad_dims)
+            grad_dims = dict(share_dim=self.grad_shard.share_dim, head_dims=self.grad_shard.head_dims,
+                             dec_dims=self.grad_shard.dec_dims)
+        self.grad_sketch = None
+        self.exact_similarity = None
+        self.gradient_layout = {'sketch_dim': None}
+        if opts.sketch_dim is not None:
+            # every rank sketches its own slice, with its own projection
+            self.grad_sketch = GradientSketcher(k=opts.sketch_dim, kind=opts.sketch_type,
+                                                seed=opts.sketch_seed + 10007 * rank, device=device, **grad_dims)
+            if opts.sketch_report:
+                self.exact_similarity = SimilarityAccumulator(nbArms, arm_cop=self.arm_cop, device=device,
+                                                              shard=self.grad_shard, **grad_dims)
+            grad_dims = dict(share_dim=self.grad_sketch.share_dim, head_dims=self.grad_sketch.head_dims,
+                             dec_dims=self.grad_sketch.dec_dims)
+            self.gradient_layout = {'sketch_dim': opts.sketch_dim, 'sketch_type': opts.sketch_type,
+                                    'sketch_seed': opts.sketch_seed, 'world_size': dist.get_world_size()}
+        if opts.similarity_mode == 'stream':
+            self.gradient_store = SimilarityAccumulator(nbArms, arm_cop=self.arm_cop, device=device,
+                                                        shard=self.grad_shard, **grad_dims)
+        else:
+            self.gradient_store = GradientStore(nbArms, self.select_freq * self.pack, arm_cop=self.arm_cop, device=device,
+                                                shard=self.grad_shard, fixed=not opts.grow_gradient_store, **grad_dims)
+        if gradient_state is not None and gradient_layout != self.gradient_layout:
+            # sketches of another projection can not be compared with the new ones, start from an empty window
+            self.logger.info('Gradient sketch settings changed, saved gradients are dropped')
+        elif isinstance(gradient_state, dict) and 'arms' in gradient_state:
+            self.gradient_store.load_state_dict(gradient_state)
+        elif gradient_state is not None:
+            self.gradient_store.load_gradient_info(gradient_state)
+
+        # background bandit updates: the window's buffers are swapped out and their Gram matrices, the influence
+        # math and the bandit update run there, only the (3, rows, rows) all-reduce of a sharded store stays on this
+        # thread. the lock guards the bandit and the lists the update appends to
+        self.bandit_lock = threading.Lock()
+        self.async_worker = None
+        self.pending_window = None
+        # (exact_similarity, num_tasks) of the sharded window whose local Gram matrices are computed in the background
+        if opts.async_bandit:
+            self.async_worker = AsyncWorker(device)
+        # instances of the next scheduled steps, generated in the background
+        self.prefetcher = InstancePrefetcher(device) if opts.prefetch > 0 else None
+
         try:
             self.num_restart = self.bandit.number_of_restart
         except:
             self.num_restart = 0
 
-        # fix the validation data and send to different gpus
-        if rank == 0:
-            self.fix_seen_validation_data = []
-            for i, cop_env in enumerate(self.env_list):
-                self.fix_seen_validation_data.append([])
-                for j, env in enumerate(cop_env):
-                    generate_data = self.overall_seen_data[i][j].cuda()
-                    generate_data_list = torch.chunk(generate_data, dist.get_world_size())
-                    for _ in range(1, dist.get_world_size()):
-                        dist.send(generate_data_list[_], dst=_, tag=i * 100 + j * 10 + _)
-
-                    self.fix_seen_validation_data[-1].append(generate_data_list[0])
-
-            self.fix_unseen_validation_data = []
-            for i, cop_env in enumerate(self.unseen_env_list):
-                self.fix_unseen_validation_data.append([])
-                for j, env in enumerate(cop_env):
-                    generate_data = self.overall_unseen_data[i][j].cuda()
-                    generate_data_list = torch.chunk(generate_data, dist.get_world_size())
-                    for _ in range(1, dist.get_world_size()):
-                        dist.send(generate_data_list[_], dst=_, tag=1000 + i * 100 + j * 10 + _)
-                    self.fix_unseen_validation_data[-1].append(generate_data_list[0])
-
-        else:
-            self.fix_seen_validation_data = []
-            for i,cop_env in enumerate(self.env_list):
-                self.fix_seen_validation_data.append([])
-                for j,env in enumerate(cop_env):
-                    generate_data = env.generate_data(opts.evaluation_size)
-                    dist.recv(generate_data, src=0, tag=i*100+j*10+self.rank)
-                    self.fix_seen_validation_data[-1].append(generate_data)
-
-            self.fix_unseen_validation_data = []
-            for i,cop_env in enumerate(self.unseen_env_list):
-                self.fix_unseen_validation_data.append([])
-                for j,env in enumerate(cop_env):
-                    generate_data = env.generate_data(opts.evaluation_size)
-                    dist.recv(generate_data, src=0, tag=1000+i*100+j*10+self.rank)
-                    self.fix_unseen_validation_data[-1].append(generate_data)
-
-
+        # fix the validation data, every rank generates its own shard
+        self.fix_seen_validation_data = []
+        for i, cop_env in enumerate(self.env_list):
+            self.fix_seen_validation_data.append([])
+            for j, env in enumerate(cop_env):
+                saved = None if saved_validation_data is None else saved_validation_data[0][i][j]
+                self.fix_seen_validation_data[-1].append(self._validation_shard(env, self.problem[i], saved))
+
+        self.fix_unseen_validation_data = []
+        for i, cop_env in enumerate(self.unseen_env_list):
+            self.fix_unseen_validation_data.append([])
+            for j, env in enumerate(cop_env):
+                saved = None if saved_validation_data is None else saved_validation_data[1][i][j]
+                self.fix_unseen_validation_data[-1].append(self._validation_shard(env, self.unseen_problem[i], saved))
+
+        device_ids = [rank] if USE_CUDA else None
         if len(self.env_list)==1:
-            self.model = DDP(self.model, device_ids=[rank])
+            self.model = DDP(self.model, device_ids=device_ids)
         else:
-            self.model = DDP(self.model, device_ids=[rank], find_unused_parameters=True)
+            self.model = DDP(self.model, device_ids=device_ids, find_unused_parameters=True)
+        # number and bytes of the gradient all-reduces of the epoch
+        self.collectives = [0, 0]
+        self.model.register_comm_hook(None, self._allreduce_hook)
 
         # utility
         self.time_estimator = TimeEstimator()
@@ -281,7 +343,14 @@ class Trainer:
             all_done = (epoch == self.trainer_params['epochs'])
             model_save_interval = self.trainer_params['logging']['model_save_interval']
 
-            if self.rank == 0 and (all_done or (epoch % model_save_interval) == 0):
+            save_checkpoint = all_done or (epoch % model_save_interval) == 0
+            if save_checkpoint:
+                if self.async_worker is not None:
+                    self._reduce_pending_window()
+                    self.async_worker.join()
+                # gathers the gradient slices, on every rank
+                gradient_state = self.gradient_store.state_dict()
+            if self.rank == 0 and save_checkpoint:
                 self.logger.info("Saving trained_model")
                 checkpoint_dict = {
                     'epoch': epoch,
@@ -298,9 +367,9 @@ class Trainer:
                     'select_freq': self.select_freq,
                     'total_count': self.total_count,
                     'eval_res': self.eval_res,
-                    'overall_seen_data': self.overall_seen_data,
-                    'overall_unseen_data': self.overall_unseen_data,
-                    'gradient_info':self.gradient_info,
+                    'val_seed': self.val_seed,
+                    'gradient_store': gradient_state,
+                    'gradient_layout': self.gradient_layout,
                     'gradient_norm': self.gradient_norm,
                     'loss_each_task': self.loss_each_task,
                     'training_time': self.training_time,
@@ -324,16 +393,21 @@ class Trainer:
 
         train_num_episode = self.trainer_params['train_episodes']
         episode = 0
+        with self.bandit_lock:
+            num_sketch_errors = len(self.sketch_errors)
         s = time.time()
+        num_steps = 0
+        self.collectives = [0, 0]
         while episode < train_num_episode:
 
-            remaining = train_num_episode - episode
-            batch_size = min(self.trainer_params['train_batch_size'], remaining)
+            batch_size = self._step_batch_size(episode)
 
+            self.epoch_episode = episode
             avg_loss, avg_score = self._train_one_batch(batch_size)
-            score_AM.update(avg_score, batch_size)
-            loss_AM.update(avg_loss, batch_size)
-            episode += batch_size
+            score_AM.update(avg_score, batch_size * self.pack)
+            loss_AM.update(avg_loss, batch_size * self.pack)
+            episode = min(episode + batch_size * self.pack, train_num_episode)
+            num_steps += 1
 
         self.training_time.append(time.time()-s)
         self.valiad_and_save_model(self.evaluation_size)
@@ -341,6 +415,29 @@ class Trainer:
         self.logger.info('Epoch {:3d}: Train ({:3.0f}%)  Score: {}  Loss: {}'
                          .format(epoch, 100. * episode / train_num_episode,
                                  self.eval_res[-1].reshape(-1), loss_AM.avg))
+        with self.bandit_lock:
+            sketch_errors = np.array(self.sketch_errors[num_sketch_errors:])
+        if self.exact_similarity is not None and len(sketch_errors) > 0:
+            self.logger.info('Epoch {:3d}: Sketch error of similarity matrix  Max: {:.4f}  Mean: {:.4f}'
+                             .format(epoch, sketch_errors[:, 0].max(), sketch_errors[:, 1].mean()))
+        self.logger.info('Epoch {:3d}: Gradient all-reduce  Steps: {}  Collectives: {}  Volume: {:.1f}MB'
+                         .format(epoch, num_steps, self.collectives[0], self.collectives[1] / 2 ** 20))
+        if self.async_worker is not None and self.async_worker.count > 0:
+            worker = self.async_worker
+            self.logger.info('Epoch {:3d}: Async bandit update  Windows: {}  Update: {:.1f}ms  Waited: {:.1f}ms  '
+                             'Hidden: {:.1f}ms per window'
+                             .format(epoch, worker.count, 1000 * worker.busy_time / worker.count,
+                                     1000 * worker.wait_time / worker.count,
+                                     1000 * (worker.busy_time - worker.wait_time) / worker.count))
+            worker.reset_stats()
+        if self.prefetcher is not None and self.prefetcher.hits + self.prefetcher.misses > 0:
+            prefetcher = self.prefetcher
+            self.logger.info('Epoch {:3d}: Instance prefetch  Hits: {}  Misses: {}  Generation: {:.1f}ms  '
+                             'Waited: {:.1f}ms per batch'
+                             .format(epoch, prefetcher.hits, prefetcher.misses,
+                                     1000 * prefetcher.generation_time / max(prefetcher.hits, 1),
+                                     1000 * prefetcher.wait_time / max(prefetcher.hits, 1)))
+            prefetcher.reset_stats()
 
         return score_AM.avg, loss_AM.avg
 
@@ -352,141 +449,308 @@ class Trainer:
 
         # POMO Rollout
         ###############################################
-        world_size = dist.get_world_size()
         num_tasks = (sum([len(cop_env) for cop_env in self.env_list]))
 
         # bandit alg for choice
-        # need to sync the choice for different ranks
-        if self.rank == 0:
-            if self.bandit_alg == 'random':
-                choice = np.random.choice(num_tasks)
-            elif  self.total_count < self.opts.warm_start *\
-                    (self.trainer_params['train_episodes']//self.trainer_params['train_batch_size']):  # we select each task once at the beginning of training
-                choice = self.total_count % num_tasks
-                self.bandit.pulls[choice] += 1
-
-            elif self.bandit_alg == 'Thompson' or self.bandit_alg == 'DiscountedThompson':
-                posterior_list = []
-                for arm in range(num_tasks):
-                    posterior_list.append(self.bandit.computeIndex(arm))
-                choice = np.argmax(posterior_list)
-                self.bandit.pulls[choice] += 1
-            else:
-                choice = self.bandit.choice()
-
-            choice = torch.tensor(choice).to(torch.device('cuda', 0))
-            for i in range(1, world_size):
-                dist.send(choice, dst=i, tag=i)
-
-        else:
-            choice = torch.tensor(1).to(torch.device('cuda', self.rank))
-            dist.recv(choice, src=0, tag=self.rank)
-
-        choice = choice.data.cpu().numpy()
+        # the choices of the whole selection window are sampled on rank 0 and shared with one broadcast
+        if len(self.choice_schedule) == 0:
+            self.choice_schedule = self._schedule_choices(num_tasks)
+        choice = self.choice_schedule.pop(0)
+        if self.prefetcher is not None:
+            self._prefetch()
         self.choice = choice
         self.choices.append(self.choice)
 
-        problem_idx, scale_id = self.select_env_cop(self.choice)
-        env = self.env_list[problem_idx][scale_id]
-        problem = self.problem[problem_idx]
-        env.load_problems(batch_size)
-        reset_s, _, _ = env.reset()
-        state, reward, done = env.pre_step()
-        self.model.module.pre_forward_oneCOP(reset_s, problem)
-        loss_mean, score_mean = self.train_one_COP(env, problem, state, reward, done)
+        arms = np.atleast_1d(choice)
+        problem_idxs = [self.select_env_cop(arm)[0] for arm in arms]
         self.optimizer.zero_grad()
-        loss_mean.backward()
-        self.optimizer.step()
-        self.loss_each_task[choice].append(loss_mean.data.item())
+        arm_grads = None
+        if len(arms) == 1:
+            # backward is done per micro-batch
+            loss_mean, score_mean = self.train_one_arm(arms[0], batch_size)
+            losses = [loss_mean]
+        else:
+            with self.model.no_sync():
+                losses, scores = self.train_packed_COPs(arms, batch_size)
+            loss_mean = torch.stack(losses).mean()
+            score_mean = np.mean(scores)
+            arm_grads = self._packed_backward(arms, losses)
+        scale = self.scaler.get_scale()
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        for arm, loss in zip(arms, losses):
+            self.loss_each_task[arm].append(loss.data.item())
         self.training_time_light.append(time.time()-s)
+        # the scale drops when the step overflowed and was skipped, its inf/nan gradients are not recorded.
+        # .grad is all-reduced, so every rank skips the same steps
+        overflow = self.scaler.is_enabled() and self.scaler.get_scale() < scale
+
+        # recored the gradient information
+        # a packed step records the gradient of every arm's own loss, see _packed_backward
+        for i, (arm, problem_idx) in enumerate([] if overflow else zip(arms, problem_idxs)):
+            if arm_grads is None:
+                grad_share = [params.grad.data for params in self.model.module.encoder.parameters()]
+                grad_ts_h = [params.grad.data for params in self.model.module.headers[problem_idx].parameters()]
+                grad_ts_d = [params.grad.data for params in self.model.module.decoders[problem_idx].parameters()]
+            else:
+                grad_share, grad_ts_h, grad_ts_d = arm_grads[i]
+                if scale != 1.:
+                    # the scaler only unscaled .grad
+                    grad_share, grad_ts_h, grad_ts_d = [[g / scale for g in grads] for grads in arm_grads[i]]
+            grads = (grad_share, grad_ts_h, grad_ts_d)
+            if self.grad_shard is not None:
+                grads = self.grad_shard(problem_idx, *grads)
+            if self.exact_similarity is not None:
+                self.exact_similarity.append(arm, *grads)
+            if self.grad_sketch is not None:
+                grads = self.grad_sketch(problem_idx, *grads)
+            self.gradient_store.append(arm, *grads)
+            if self.rank == 0:
+                grad_norm = torch.linalg.vector_norm(torch.stack([torch.linalg.vector_norm(g) for g in grad_share + grad_ts_h + grad_ts_d]))
+                self.gradient_norm[arm].append([grad_norm.cpu().data.item()])
 
-        if self.rank == 0:
-            # recored the gradient information
-            grad_share = []
-            for name, params in self.model.module.encoder.named_parameters():
-                grad_share.append(params.grad.data.view(-1))
-            grad_share = torch.cat(grad_share)
-
-            grad_ts_h = []
-            for name, params in self.model.module.headers[problem_idx].named_parameters():
-                grad_ts_h.append(params.grad.data.view(-1))
-            grad_ts_h = torch.cat(grad_ts_h)
-            grad_ts_d = []
-            for name, params in self.model.module.decoders[problem_idx].named_parameters():
-                grad_ts_d.append(params.grad.data.view(-1))
-            grad_ts_d = torch.cat(grad_ts_d)
-
-            for c in range(num_tasks):
-                if c == choice:
-                    if len(self.gradient_info[c])==0:
-                        self.gradient_info[c][0] = [[grad_share, grad_ts_h, grad_ts_d], 1]
-                    else:
-                        self.gradient_info[c][len(self.gradient_info[c])] = [[grad_share, grad_ts_h, grad_ts_d], self.gradient_info[c][len(self.gradient_info[c])-1][1]+1]
-                else:
-                    if len(self.gradient_info[c])==0:
-                        self.gradient_info[c][0] = [[], 0]
-                    else:
-                        self.gradient_info[c][len(self.gradient_info[c])] = [[], self.gradient_info[c][len(self.gradient_info[c])-1][1]]
-                        
-            self.gradient_norm[choice].append(
-                [torch.norm(torch.cat([grad_share, grad_ts_h, grad_ts_d])).cpu().data.item()])
-
-        if self.total_count >= self.opts.warm_start * \
-                int(self.trainer_params['train_episodes'] / self.trainer_params['train_batch_size']) \
+        if self.pending_window is not None:
+            # the local Gram matrices of the last window were computed during this step
+            self._reduce_pending_window()
+        if self.total_count >= self.opts.warm_start * self.epoch_steps \
                 and self.total_count % self.select_freq == 0 \
                 and self.total_count != 0:
             # update ts using gradient information
-            if self.rank == 0:
-                M_similarity, M_similarity_share, M_similarity_head, M_similarity_dec = self.get_influ_mat()
-                self.influ_mats_sim.append(M_similarity)
-                self.influ_mats_sim_share.append(M_similarity_share)
-                self.influ_mats_sim_header.append(M_similarity_head)
-                self.influ_mats_sim_dec.append(M_similarity_dec)
-                reward_for_each_task = 1 / (1 + np.exp(-M_similarity.sum(axis=0)))
-                grad_info_num = np.array([list(val.items())[-1][1][1] for _, val in self.gradient_info.items()])
-                reward_for_each_task[grad_info_num == 0] = 0
-
-                for task_idx in range(num_tasks):
-                    select_counts = self.gradient_info[task_idx][2]
-                    if select_counts != 0:
-                        self.bandit.getReward(task_idx, reward_for_each_task[task_idx])
-
-                    if self.bandit_alg == 'Thompson' or self.bandit_alg == 'DiscountedThompson':
-                        self.bandit.rewards[task_idx] += reward_for_each_task[task_idx]
-
-                self.rewards.append(reward_for_each_task)
-                temp_gradient_info = {i:{} for i in range(num_tasks)}
-                for i in range(num_tasks):
-                    for key, val in self.gradient_info[i].items():
-                        if len(val[0])!=0:
-                            temp_gradient_info[i][0] = [val[0], 1]
-                
-                self.gradient_info = temp_gradient_info
+            if self.async_worker is not None:
+                self._submit_window(num_tasks)
+            else:
+                self._update_bandit(self.gradient_store, self.exact_similarity, num_tasks)
+                self.gradient_store.reset()
+            if self.exact_similarity is not None:
+                self.exact_similarity.reset()
         self.total_count += 1
 
         return loss_mean.data.item(), score_mean
 
-    def train_one_COP(self, env, problem, state, reward, done):
-        prob_list = torch.zeros(size=(env.batch_size, env.pomo_size, 0))
+    def _submit_window(self, num_tasks):
+        # the buffers of the window are swapped out, once the update of the previous window is over since its
+        # buffers are reused, and its Gram matrices are computed on the worker's side stream. a sharded window has
+        # its partial Gram matrices all-reduced at the end of the next step, see _reduce_pending_window
+        self.async_worker.join()
+        window = self.gradient_store.swap()
+        exact_similarity = None if self.exact_similarity is None else self.exact_similarity.reduced()
+        if self.grad_shard is None:
+            self.async_worker.submit(self._update_bandit, window, exact_similarity, num_tasks)
+        else:
+            self.async_worker.submit(window.local)
+            self.pending_window = (exact_similarity, num_tasks)
+
+    def _reduce_pending_window(self):
+        # called at the same step on every rank, so the all-reduce is in the same order everywhere
+        if self.pending_window is None:
+            return
+        exact_similarity, num_tasks = self.pending_window
+        self.pending_window = None
+        window = self.async_worker.join().all_reduce(self.grad_shard)
+        self.async_worker.submit(self._update_bandit, window, exact_similarity, num_tasks)
+
+    def autocast(self):
+        return torch.autocast(self.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None)
+
+    def _micro_batch_sizes(self, arm, batch_size):
+        # the batch is split into micro-batches of the size set for this (problem, scale), see self.micro_batch_size
+        problem_idx, scale_id = self.select_env_cop(arm)
+        env = self.env_list[problem_idx][scale_id]
+        key = (self.problem[problem_idx], env.problem_size)
+        if key not in self.micro_batch_size and self.probe_micro_batch:
+            self.micro_batch_size[key] = self._probe_micro_batch(arm)
+            self.logger.info('Micro-batch size of {}{}: {}'.format(*key, self.micro_batch_size[key]))
+        micro_batch_size = self.micro_batch_size.get(key, self.micro_batch_size.get(None, batch_size))
+        return [min(micro_batch_size, batch_size - start) for start in range(0, batch_size, micro_batch_size)]
+
+    def _probe_micro_batch(self, arm, probe_sizes=(4, 8), memory_fraction=0.9):
+        # peak memory of a training forward and backward of the arm at two small batch sizes, extrapolated linearly
+        # to the largest size that fits in memory_fraction of the memory left, at most train_batch_size.
+        # the inner model is used so the probes do not synchronize, the smallest size over the ranks is returned
+        problem_idx, scale_id = self.select_env_cop(arm)
+        env = self.env_list[problem_idx][scale_id]
+        problem = self.problem[problem_idx]
+        model = self.model.module
+        max_size = self.trainer_params['train_batch_size']
+        peaks = []
+        for size in probe_sizes:
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            base = torch.cuda.memory_allocated(self.device)
+            env.load_problems(size)
+            reset_s, _, _ = env.reset()
+            state, reward, done = env.pre_step()
+            with self.autocast():
+                model.pre_forward_oneCOP(reset_s, problem)
+                loss_mean, _ = self.train_one_COP(env, problem, state, reward, done, model)
+            loss_mean.backward()
+            peaks.append(torch.cuda.max_memory_allocated(self.device) - base)
+            del loss_mean
+        for params in model.parameters():
+            params.grad = None
+
+        per_instance = max((peaks[1] - peaks[0]) / (probe_sizes[1] - probe_sizes[0]), 1)
+        fixed = max(peaks[0] - per_instance * probe_sizes[0], 0)
+        free, _ = torch.cuda.mem_get_info(self.device)
+        free += torch.cuda.memory_reserved(self.device) - torch.cuda.memory_allocated(self.device)
+        size = torch.tensor(int((memory_fraction * free - fixed) // per_instance), device=self.device)
+        dist.all_reduce(size, op=dist.ReduceOp.MIN)
+        return int(size.clamp(1, max_size).item())
+
+    def _step_batch_size(self, episode):
+        # batch size of the step starting at this episode of the epoch, a packed step trains every one of its arms
+        # on batch_size episodes
+        remaining = self.trainer_params['train_episodes'] - episode
+        return min(self.trainer_params['train_batch_size'], -(-remaining // self.pack))
+
+    def _prefetch(self):
+        # queue the instances of the scheduled steps up to --prefetch steps ahead, they are generated while the
+        # current step trains. the choices after the end of the schedule are not known until the bandit update.
+        # the batches are keyed by (step, arm, micro-batch) and have the size of their step, which is the last
+        # partial batch at the end of an epoch
+        step = self.total_count + 1
+        # shape: choice_schedule[i] is the choice of the step step+i
+        num_steps = min(self.opts.prefetch, len(self.choice_schedule))
+        episode = self.epoch_episode + self._step_batch_size(self.epoch_episode) * self.pack
+        for i in range(num_steps):
+            if episode >= self.trainer_params['train_episodes']:
+                episode = 0
+            batch_size = self._step_batch_size(episode)
+            episode += batch_size * self.pack
+            if step + i < self.prefetched_until:
+                continue
+            arms = np.atleast_1d(self.choice_schedule[i])
+            for arm in arms:
+                problem_idx, scale_id = self.select_env_cop(arm)
+                env = self.env_list[problem_idx][scale_id]
+                sizes = self._micro_batch_sizes(arm, batch_size) if len(arms) == 1 else [batch_size]
+                for part, size in enumerate(sizes):
+                    self.prefetcher.put((step + i, arm, part), env.random_problems, size)
+        self.prefetched_until = max(self.prefetched_until, step + num_steps)
+
+    def _validation_shard(self, env, problem, saved=None):
+        # the evaluation_size validation instances of this rank, generated on the cpu. instance k of the stream of
+        # (val_seed, problem, problem_size) has its own generator seeded with k, and rank r takes the instances
+        # r*evaluation_size .. (r+1)*evaluation_size-1, so the data of n ranks is the first n*evaluation_size instances
+        # of the stream whatever the order of the problems in the config, the world size or the device
+        # saved: the validation data of all the ranks, kept in older checkpoints
+        if saved is not None:
+            return torch.chunk(saved, dist.get_world_size())[self.rank].to(self.device)
+        start = self.rank * self.evaluation_size
+        instances = []
+        for k in range(start, start + self.evaluation_size):
+            seed = np.random.SeedSequence([self.val_seed, zlib.crc32(problem.encode()), env.problem_size, k])
+            generator = torch.Generator().manual_seed(int(seed.generate_state(1)[0]))
+            instances.append(env.generate_data(1, device='cpu', generator=generator))
+        return torch.cat(instances, dim=0).to(self.device)
+
+    def _load_problems(self, env, arm, batch_size, part=0):
+        # part: index of the micro-batch in the step
+        generated = None if self.prefetcher is None else self.prefetcher.get((self.total_count, arm, part), batch_size)
+        env.load_problems(batch_size, generated=generated)
+
+    def train_one_arm(self, arm, batch_size):
+        # the gradients of the micro-batches (see _micro_batch_sizes) are accumulated and only the last backward
+        # is synchronized over the ranks
+        problem_idx, scale_id = self.select_env_cop(arm)
+        env = self.env_list[problem_idx][scale_id]
+        problem = self.problem[problem_idx]
+        sizes = self._micro_batch_sizes(arm, batch_size)
+
+        loss_sum, score_sum = 0, 0
+        for i, size in enumerate(sizes):
+            self._load_problems(env, arm, size, i)
+            reset_s, _, _ = env.reset()
+            state, reward, done = env.pre_step()
+            with self.model.no_sync() if i < len(sizes) - 1 else contextlib.nullcontext():
+                with self.autocast():
+                    self.model.module.pre_forward_oneCOP(reset_s, problem)
+                    loss_mean, score_mean = self.train_one_COP(env, problem, state, reward, done)
+                self.scaler.scale(loss_mean * size / batch_size).backward()
+            loss_sum += loss_mean.detach() * size
+            score_sum += score_mean * size
+        return loss_sum / batch_size, score_sum / batch_size
+
+    def _allreduce_hook(self, state, bucket):
+        # the default gradient all-reduce of DDP, counted in self.collectives
+        self.collectives[0] += 1
+        self.collectives[1] += bucket.buffer().numel() * bucket.buffer().element_size()
+        return default_hooks.allreduce_hook(None, bucket)
+
+    def _packed_backward(self, arms, losses):
+        # the optimizer step uses the gradient of the mean loss, the bandit the gradient of each arm's own loss, so
+        # every arm has a backward of its own. the packed forward ran under no_sync, the gradients of all the arms
+        # are averaged over the ranks here in one all_reduce, then their mean is written to .grad
+        # returns the (encoder, header, decoder) gradients of every arm, scaled as .grad is
+        model = self.model.module
+        groups, flat = [], []
+        for i, (arm, loss) in enumerate(zip(arms, losses)):
+            problem_idx = self.select_env_cop(arm)[0]
+            group = [list(model.encoder.parameters()), list(model.headers[problem_idx].parameters()),
+                     list(model.decoders[problem_idx].parameters())]
+            params = [p for group_params in group for p in group_params]
+            grads = torch.autograd.grad(self.scaler.scale(loss), params, retain_graph=i < len(losses) - 1,
+                                        allow_unused=True)
+            flat += [p.new_zeros(p.numel()) if g is None else g.reshape(-1) for p, g in zip(params, grads)]
+            groups.append(group)
+        flat = torch.cat(flat)
+        if dist.get_world_size() > 1:
+            self.collectives[0] += 1
+            self.collectives[1] += flat.numel() * flat.element_size()
+            dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+            flat /= dist.get_world_size()
+
+        arm_grads = []
+        offset = 0
+        for group in groups:
+            arm_grads.append([])
+            for group_params in group:
+                arm_grads[-1].append([])
+                for p in group_params:
+                    grad = flat[offset:offset + p.numel()].view_as(p)
+                    offset += p.numel()
+                    arm_grads[-1][-1].append(grad)
+                    p.grad = grad / len(arms) if p.grad is None else p.grad + grad / len(arms)
+        return arm_grads
+
+    def train_packed_COPs(self, arms, batch_size):
+        # the problems of several arms are encoded together, then rolled out one after the other
+        envs, problems, reset_states = [], [], []
+        for arm in arms:
+            problem_idx, scale_id = self.select_env_cop(arm)
+            env = self.env_list[problem_idx][scale_id]
+            self._load_problems(env, arm, batch_size)
+            reset_s, _, _ = env.reset()
+            envs.append(env)
+            problems.append(self.problem[problem_idx])
+            reset_states.append(reset_s)
+        with self.autocast():
+            encoded_nodes = self.model.module.pre_forward_packed(reset_states, problems)
+
+            losses, scores = [], []
+            for env, problem, encoded in zip(envs, problems, encoded_nodes):
+                self.model.module.set_encoding(encoded, problem)
+                state, reward, done = env.pre_step()
+                loss_mean, score_mean = self.train_one_COP(env, problem, state, reward, done)
+                losses.append(loss_mean)
+                scores.append(score_mean)
+        return losses, scores
+
+    def train_one_COP(self, env, problem, state, reward, done, model=None):
+        # model: the DDP model by default
+        model = self.model if model is None else model
+        if self.opts.rollout == 'two_phase':
+            reward, log_prob = two_phase_rollout(model, env, problem, state, reward, done,
+                                                 self.opts.rollout_chunk, self.opts.rollout_checkpoint)
+        else:
+            # the log-probabilities of the dropped instances stay fixed, they are 0 after they finished
+            reward, log_prob = rollout(model, env, problem, state, reward, done, self.opts.compact)
+        # shape: (batch, pomo)
 
-        # shape: (batch, pomo, 0~problem)
-        while not done:
-            selected, prob = self.model(state, problem)
-            # shape: (batch, pomo)
-            state, reward, done = env.step(selected)
-            try:
-                # selected = state.true_selected  # the selected nodes may change due to some hard constrain, e.g. in OP
-                prob = prob[state.BATCH_IDX, state.POMO_IDX, selected].reshape(state.BATCH_IDX.size(0),
-                                                             state.BATCH_IDX.size(1))
-            except:
-                pass
-            prob_list = torch.cat((prob_list, prob[:, :, None]), dim=2)
         # Loss
         ###############################################
         advantage = reward - reward.float().mean(dim=1, keepdims=True)
         # shape: (batch, pomo)
-        log_prob = prob_list.log().sum(dim=2)
-        # size = (batch, pomo)
         loss = -advantage * log_prob  # Minus Sign: To Increase REWARD
         # shape: (batch, pomo)
         loss_mean = loss.mean()
@@ -497,89 +761,99 @@ class Trainer:
         score_mean = torch.abs(max_pomo_reward.float().mean())  # negative sign to make positive value
         return loss_mean, score_mean.item()
 
-    def get_influ_mat(self):
-        M_similarity = torch.zeros((len(self.gradient_info),len(self.gradient_info))).cuda()
-        M_similarity_share = torch.zeros((len(self.gradient_info),len(self.gradient_info))).cuda()
-        M_similarity_head = torch.zeros((len(self.gradient_info),len(self.gradient_info))).cuda()
-        M_similarity_dec = torch.zeros((len(self.gradient_info),len(self.gradient_info))).cuda()
-
-        cum_scales_per_cop = np.cumsum([len(cop_env) for cop_env in self.env_list])
-        intervals = len(self.gradient_info[0])
-        for i in range(len(self.gradient_info)):
-            cop_i = np.where((i < cum_scales_per_cop) == True)[0][0]
-            # without assumption 1, the grad_i should be the grad on its first occurance
-            grad_i = self.gradient_info[i]
-            for j in range(len(self.gradient_info)):
-                grad_j = self.gradient_info[j]
-                count_j = grad_j[intervals-1][1]
-                if count_j!=0:
-                    cop_j = np.where((j < cum_scales_per_cop) == True)[0][0]
-                    if cop_i == cop_j: # i,j are same kind of COP
-                        temp_all_sim = 0
-                        temp_header_sim = 0
-                        temp_dec_sim = 0
-                        temp_share_sim = 0
-                        
-                        for t in range(intervals):
-                            if len(grad_i[t][0]) != 0:
-                                lastest_grad_i_t = torch.cat(grad_i[t][0])
-                                lastest_share_grad_i_t = grad_i[t][0][0]
-                                lastest_head_grad_i_t = grad_i[t][0][1]
-                                lastest_dec_grad_i_t = grad_i[t][0][2]
-                                no_grad_i=False
-                            else:
-                                lastest_grad_i_t = torch.zeros(1).cuda()
-                                lastest_share_grad_i_t =torch.zeros(1).cuda()
-                                lastest_head_grad_i_t = torch.zeros(1).cuda()
-                                lastest_dec_grad_i_t = torch.zeros(1).cuda()
-                                no_grad_i = True
-                                for temp in range(t,-1,-1):
-                                    if len(grad_i[temp][0]) != 0:
-                                        no_grad_i = False
-                                        lastest_grad_i_t = torch.cat(grad_i[temp][0])
-                                        lastest_share_grad_i_t = grad_i[temp][0][0]
-                                        lastest_head_grad_i_t = grad_i[temp][0][1]
-                                        lastest_dec_grad_i_t = grad_i[temp][0][2]
-                                        break
-                                
-                            if len(grad_j[t][0]) != 0 and (not no_grad_i):
-                                lastest_grad_j_t = torch.cat(grad_j[t][0])
-                                lastest_share_grad_j_t = grad_j[t][0][0]
-                                lastest_head_grad_j_t = grad_j[t][0][1]
-                                lastest_dec_grad_j_t = grad_j[t][0][2]
-                                
-                                temp_all_sim += (lastest_grad_i_t*lastest_grad_j_t).sum()/(torch.linalg.vector_norm(lastest_grad_i_t)*torch.linalg.vector_norm(lastest_grad_j_t))                  
-                                temp_header_sim += (lastest_head_grad_i_t*lastest_head_grad_j_t).sum()/(torch.linalg.vector_norm(lastest_head_grad_i_t)*torch.linalg.vector_norm(lastest_head_grad_j_t))
-                                temp_dec_sim += (lastest_dec_grad_i_t*lastest_dec_grad_j_t).sum()/(torch.linalg.vector_norm(lastest_dec_grad_i_t)*torch.linalg.vector_norm(lastest_dec_grad_j_t))
-                                temp_share_sim += (lastest_share_grad_i_t*lastest_share_grad_j_t).sum()/(torch.linalg.vector_norm(lastest_share_grad_i_t)*torch.linalg.vector_norm(lastest_share_grad_j_t))
-
-                        M_similarity[i, j] = temp_all_sim/count_j
-                        M_similarity_share[i, j] = temp_share_sim/count_j
-                        M_similarity_head[i, j] = temp_header_sim/count_j
-                        M_similarity_dec[i,j] = temp_dec_sim/count_j
-                        
-                    else: #i,j are different kinds of COP
-                        temp_share_sim = 0
-                        for t in range(intervals):
-                            if len(grad_i[t][0]) != 0:
-                                lastest_share_grad_i_t = grad_i[t][0][0]
-                                no_grad_i=False
-                            else:
-                                lastest_share_grad_i_t = torch.zeros(1).cuda()
-                                no_grad_i = True
-                                for temp in range(t,-1,-1):
-                                    if len(grad_i[temp][0]) != 0:
-                                        lastest_share_grad_i_t =  grad_i[temp][0][0]
-                                        no_grad_i=False
-                                        break
-                                    
-                            if len(grad_j[t][0]) != 0 and (not no_grad_i):
-                                lastest_share_grad_j_t = grad_j[t][0][0]
-                                temp_share_sim += (lastest_share_grad_i_t*lastest_share_grad_j_t).sum()/(torch.linalg.vector_norm(lastest_share_grad_i_t)*torch.linalg.vector_norm(lastest_share_grad_j_t))
-
-                        M_similarity_share[i,j] = temp_share_sim/count_j
-                        M_similarity[i,j] = temp_share_sim/count_j
-        return M_similarity.cpu().numpy(), M_similarity_share.cpu().numpy(), M_similarity_head.cpu().numpy(), M_similarity_dec.cpu().numpy()
+    def _select_arm(self, count, num_tasks):
+        if self.bandit_alg == 'random':
+            choice = np.random.choice(num_tasks)
+        elif  count < self.opts.warm_start * self.epoch_steps:  # we select each task once at the beginning of training
+            choice = count % num_tasks
+            self.bandit.pulls[choice] += 1
+
+        elif self.bandit_alg == 'Thompson' or self.bandit_alg == 'DiscountedThompson':
+            posterior_list = []
+            for arm in range(num_tasks):
+                posterior_list.append(self.bandit.computeIndex(arm))
+            choice = np.argmax(posterior_list)
+            self.bandit.pulls[choice] += 1
+        else:
+            choice = self.bandit.choice()
+        return choice
+
+    def _select_arms(self, count, num_tasks):
+        # self.pack distinct arms, trained together in one step
+        if self.bandit_alg == 'random':
+            arms = np.random.choice(num_tasks, self.pack, replace=False)
+        elif  count < self.opts.warm_start * self.epoch_steps:
+            arms = (count * self.pack + np.arange(self.pack)) % num_tasks
+            self.bandit.pulls[arms] += 1
+        elif self.bandit_alg == 'Thompson' or self.bandit_alg == 'DiscountedThompson':
+            posterior_list = []
+            for arm in range(num_tasks):
+                posterior_list.append(self.bandit.computeIndex(arm))
+            arms = np.argsort(posterior_list)[::-1][:self.pack]
+            self.bandit.pulls[arms] += 1
+        elif hasattr(self.bandit, 'choiceMultiple'):
+            arms = self.bandit.choiceMultiple(self.pack)
+        else:
+            arms = []
+            while len(arms) < self.pack:
+                arm = self.bandit.choice()
+                if arm not in arms:
+                    arms.append(arm)
+        return np.asarray(arms)
+
+    def _schedule_choices(self, num_tasks):
+        # choices from the current batch up to the next bandit update, the posterior does not change in between
+        warm_steps = self.opts.warm_start * self.epoch_steps
+        window_end = max(self.total_count, warm_steps, 1)
+        window_end += -window_end % self.select_freq
+        num_steps = window_end - self.total_count + 1
+        schedule = torch.zeros((num_steps + 1, self.pack), dtype=torch.long, device=self.device)
+        # the last row holds the number of scheduled steps
+        if self.rank == 0:
+            if self.async_worker is not None and (self.pending_window is not None or not self.async_worker.done()):
+                # the update of the last window is still running, one step is scheduled at a time until its
+                # posterior is there, instead of the whole window with the one before
+                num_steps = 1
+            select_arm = self._select_arm if self.pack == 1 else self._select_arms
+            with self.bandit_lock:
+                choices = [select_arm(count, num_tasks) for count in range(self.total_count, self.total_count + num_steps)]
+            schedule[:num_steps].copy_(torch.tensor(np.array(choices)).reshape(num_steps, self.pack))
+            schedule[-1, 0] = num_steps
+        dist.broadcast(schedule, src=0)
+        schedule = schedule.cpu().numpy()
+        return [arms[0] if self.pack == 1 else arms for arms in schedule[:schedule[-1, 0]]]
+
+    def _update_bandit(self, gradient_store, exact_similarity, num_tasks):
+        # gradient_store, exact_similarity: the stores, or their swapped out / reduced windows when run in the
+        # background
+        # the bandit is updated on rank 0
+        M_similarity, M_similarity_share, M_similarity_head, M_similarity_dec = self.get_influ_mat(gradient_store)
+        if exact_similarity is not None:
+            sketch_error = np.abs(M_similarity - exact_similarity.influence()[0])
+            with self.bandit_lock:
+                self.sketch_errors.append([sketch_error.max(), sketch_error.mean()])
+        if self.rank != 0:
+            return
+        reward_for_each_task = 1 / (1 + np.exp(-M_similarity.sum(axis=0)))
+        select_counts = gradient_store.counts()
+        reward_for_each_task[select_counts == 0] = 0
+
+        with self.bandit_lock:
+            self.influ_mats_sim.append(M_similarity)
+            self.influ_mats_sim_share.append(M_similarity_share)
+            self.influ_mats_sim_header.append(M_similarity_head)
+            self.influ_mats_sim_dec.append(M_similarity_dec)
+            for task_idx in range(num_tasks):
+                # the arms without any gradient get a reward of 0
+                self.bandit.getReward(task_idx, reward_for_each_task[task_idx])
+
+                if self.bandit_alg == 'Thompson' or self.bandit_alg == 'DiscountedThompson':
+                    self.bandit.rewards[task_idx] += reward_for_each_task[task_idx]
+            self.rewards.append(reward_for_each_task)
+
+    def get_influ_mat(self, gradient_store=None):
+        gradient_store = self.gradient_store if gradient_store is None else gradient_store
+        return gradient_store.influence()
 
     def valiadate(self,batch_size):
         self.model.eval()
@@ -629,14 +903,10 @@ class Trainer:
                     for i in range(len(cop_env)):
                         env = cop_env[i]
 
-                        with torch.no_grad():
+                        with torch.no_grad(), self.autocast():
                             model.module.pre_forward_oneCOP(reset_state[j][i], problem)
                             state, reward, done = states[j][i], rewards[j][i], dones[j][i]
-                            # shape: (batch, pomo, 0~problem)
-                            while not done:
-                                selected, _ = model(state, problem)
-                                # shape: (batch, pomo)
-                                state, reward, done = env.step(selected)
+                            reward, _ = rollout(model, env, problem, state, reward, done, self.opts.compact)
 
                             # Score
                             ###############################################
@@ -0,0 +1,579 @@
+import argparse
+import time
+import numpy as np
+import torch
+import yaml
+
+from Env.COPEnv import COPEnv as Env
+from Models.models import COPModel as Model, reshape_by_heads, _get_encoding
+from rollout import rollout, two_phase_rollout
+from prefetcher import InstancePrefetcher
+
+
+def load_model_env(problem, problem_size, device, **model_overrides):
+    with open('./config.yaml') as f:
+        config = yaml.load(f, Loader=yaml.SafeLoader)
+    model_params = dict(config['model_params'], **model_overrides)
+    model_params['sqrt_embedding_dim'] = model_params['embedding_dim'] ** (.5)
+    env_params = {problem: dict(config['env_params'][problem], problem_size=[problem_size],
+                                pomo_size=[min(problem_size, 100)])}
+
+    if device.type == 'cuda':
+        torch.cuda.set_device(device)
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+    model = Model([problem], **model_params).to(device)
+    env = Env(**env_params).env_list[0][0]
+    return model, env
+
+
+def timed(fn, repeat, device):
+    # average time (ms) of fn over repeat runs after one warm-up run, and the peak memory (MB) on GPU
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    s = time.time()
+    for _ in range(repeat):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        peak = torch.cuda.max_memory_allocated(device) / 2 ** 20
+    else:
+        peak = float('nan')
+    return 1000 * (time.time() - s) / repeat, peak
+
+
+def report(name, ms, peak):
+    print('{:<24s} {:10.2f} ms {:10.1f} MB'.format(name, ms, peak))
+
+
+########################################
+# ROLLOUT
+########################################
+
+def legacy_probs(model, state, problem):
+    # the distribution the former forward sampled from, None at the first moves whose nodes are fixed.
+    # the decoder now ends with a log_softmax, its exp stands for the former softmax
+    idx = model.idxs[problem]
+    decoder = model.decoders[idx]
+    encoded_nodes = model.encoded_nodes[idx]
+    if problem == 'TSP' and state.current_node is not None:
+        return decoder(_get_encoding(encoded_nodes, state.current_node), state.mask).exp()
+    if problem == 'KP' and state.current_node is not None:
+        return decoder(state.capacity, state.fit_mask).exp()
+    if problem in ['CVRP', 'OP'] and state.selected_count >= 2:
+        feature = state.load if problem == 'CVRP' else state.remain_dist
+        return decoder(_get_encoding(encoded_nodes, state.current_node), feature, state.mask).exp()
+    return None
+
+
+def legacy_rollout(model, env, problem, state, reward, done):
+    # the former COPModel forward and Trainer.train_one_COP: multinomial over the step probabilities, redrawn
+    # while it picks a zero-probability node, the probabilities of the selected nodes are concatenated, then
+    # log and sum at the end
+    prob_list = torch.zeros(size=(env.batch_size, env.pomo_size, 0))
+    while not done:
+        batch_size, pomo_size = state.BATCH_IDX.shape
+        probs = legacy_probs(model, state, problem)
+        if probs is None:
+            selected, _ = model(state, problem)
+            prob = torch.ones(size=(batch_size, pomo_size))
+        else:
+            while True:
+                with torch.no_grad():
+                    selected = probs.reshape(batch_size * pomo_size, -1).multinomial(1) \
+                        .squeeze(dim=1).reshape(batch_size, pomo_size)
+                prob = probs[state.BATCH_IDX, state.POMO_IDX, selected].reshape(batch_size, pomo_size)
+                if (prob != 0).all():
+                    break
+        state, reward, done = env.step(selected)
+        prob_list = torch.cat((prob_list, prob[:, :, None]), dim=2)
+    return reward, prob_list.log().sum(dim=2)
+
+
+def bench_rollout(opts):
+    device = torch.device(opts.device)
+    model, env = load_model_env(opts.problem, opts.problem_size, device)
+    model.train()
+
+    def train_step(rollout_fn):
+        env.load_problems(opts.batch_size)
+        reset_s, _, _ = env.reset()
+        state, reward, done = env.pre_step()
+        model.pre_forward_oneCOP(reset_s, opts.problem)
+        reward, log_prob = rollout_fn(model, env, opts.problem, state, reward, done)
+        advantage = reward - reward.float().mean(dim=1, keepdims=True)
+        loss = (-advantage * log_prob).mean()
+        model.zero_grad()
+        loss.backward()
+
+    print('{}{} batch {}, forward + backward'.format(opts.problem, opts.problem_size, opts.batch_size))
+    report('prob_list cat', *timed(lambda: train_step(legacy_rollout), opts.repeat, device))
+    report('running log-prob', *timed(lambda: train_step(rollout), opts.repeat, device))
+    report('two-phase', *timed(lambda: train_step(two_phase_rollout), opts.repeat, device))
+
+
+########################################
+# AMP
+########################################
+
+def bench_amp(opts):
+    device = torch.device(opts.device)
+    model, env = load_model_env(opts.problem, opts.problem_size, device)
+    torch.manual_seed(1234)
+    validation_data = env.generate_data(opts.evaluation_size)
+    dtypes = {'fp32': None, 'bf16': torch.bfloat16}
+    if device.type == 'cuda':
+        dtypes['fp16'] = torch.float16
+
+    def autocast(dtype):
+        return torch.autocast(device.type, dtype=dtype, enabled=dtype is not None)
+
+    def train_step(dtype):
+        model.train()
+        env.load_problems(opts.batch_size)
+        reset_s, _, _ = env.reset()
+        state, reward, done = env.pre_step()
+        with autocast(dtype):
+            model.pre_forward_oneCOP(reset_s, opts.problem)
+            reward, log_prob = rollout(model, env, opts.problem, state, reward, done)
+            advantage = reward - reward.float().mean(dim=1, keepdims=True)
+            loss = (-advantage * log_prob).mean()
+        model.zero_grad()
+        loss.backward()
+
+    def validate(dtype):
+        model.eval()
+        env.load_problems(opts.evaluation_size, prepare_dataset=validation_data)
+        reset_s, _, _ = env.reset()
+        state, reward, done = env.pre_step()
+        with torch.no_grad(), autocast(dtype):
+            model.pre_forward_oneCOP(reset_s, opts.problem)
+            reward, _ = rollout(model, env, opts.problem, state, reward, done)
+        return reward.max(dim=1)[0].float().mean().abs().item()
+
+    print('{}{} batch {}, validation on {} instances'.format(opts.problem, opts.problem_size, opts.batch_size,
+                                                            opts.evaluation_size))
+    reference = validate(None)
+    for name, dtype in dtypes.items():
+        report('{} train step'.format(name), *timed(lambda: train_step(dtype), opts.repeat, device))
+        report('{} validation'.format(name), *timed(lambda: validate(dtype), opts.repeat, device))
+        score = validate(dtype)
+        print('{:<24s} {:10.4f}   gap {:+.3f}%'.format('{} score'.format(name), score,
+                                                        100 * (score - reference) / reference))
+
+
+########################################
+# ATTENTION
+########################################
+
+def bench_attention(opts):
+    # the same weights with the fused attention and the reference one, greedy validation rollouts
+    device = torch.device(opts.device)
+    models = {}
+    for name in ['reference', 'sdpa']:
+        models[name], env = load_model_env(opts.problem, opts.problem_size, device, attention=name)
+        models[name].eval()
+    models['sdpa'].load_state_dict(models['reference'].state_dict())
+    torch.manual_seed(1234)
+    validation_data = env.generate_data(opts.batch_size)
+
+    def validate(model):
+        env.load_problems(opts.batch_size, prepare_dataset=validation_data)
+        reset_s, _, _ = env.reset()
+        state, reward, done = env.pre_step()
+        with torch.no_grad():
+            model.pre_forward_oneCOP(reset_s, opts.problem)
+            reward, _ = rollout(model, env, opts.problem, state, reward, done)
+        return reward
+
+    print('{}{} batch {}, greedy rollout'.format(opts.problem, opts.problem_size, opts.batch_size))
+    for name, model in models.items():
+        report(name, *timed(lambda: validate(model), opts.repeat, device))
+    reset_s, _, _ = env.reset()
+    encoded = []
+    with torch.no_grad():
+        for model in models.values():
+            model.pre_forward_oneCOP(reset_s, opts.problem)
+            encoded.append(model.encoded_nodes[0])
+    print('max abs difference of the encodings: {:.3e}'.format((encoded[0] - encoded[1]).abs().max().item()))
+    print('max abs difference of the rewards:   {:.3e}'.format(
+        (validate(models['reference']) - validate(models['sdpa'])).abs().max().item()))
+
+
+########################################
+# KP QUERY
+########################################
+
+def bench_kp_query(opts):
+    # the query of one KP decoding step: the former expand, cat and full Wq projection against the graph part
+    # precomputed in set_kv plus the capacity column
+    device = torch.device(opts.device)
+    model, env = load_model_env('KP', opts.problem_size, device)
+    model.eval()
+    decoder = model.decoders[model.idxs['KP']]
+    env.load_problems(opts.batch_size)
+    reset_s, _, _ = env.reset()
+    state, reward, done = env.pre_step()
+
+    with torch.no_grad():
+        model.pre_forward_oneCOP(reset_s, 'KP')
+        encoded_graph = model.encoded_nodes[model.idxs['KP']].mean(dim=1, keepdim=True)
+        capacity = state.capacity
+
+        def legacy_query():
+            input1 = encoded_graph.expand(capacity.size(0), capacity.size(1), decoder.embedding_dim)
+            input_cat = torch.cat((input1, capacity[:, :, None]), dim=2)
+            return reshape_by_heads(decoder.Wq(input_cat), head_num=decoder.head_num)
+
+        def fused_query():
+            q = decoder.q_graph + capacity[:, :, None].to(decoder.q_capacity.dtype) * decoder.q_capacity
+            return reshape_by_heads(q, head_num=decoder.head_num)
+
+        def validate():
+            # greedy rollout, returns its number of decoding steps
+            env.load_problems(opts.batch_size, prepare_dataset=validation_data)
+            reset_s, _, _ = env.reset()
+            state, reward, done = env.pre_step()
+            model.pre_forward_oneCOP(reset_s, 'KP')
+            num_steps = 0
+            while not done:
+                selected, _ = model(state, 'KP')
+                state, reward, done = env.step(selected)
+                num_steps += 1
+            return num_steps
+
+        print('KP{} batch {}, query of one decoding step'.format(opts.problem_size, opts.batch_size))
+        report('expand + cat + Wq', *timed(legacy_query, opts.repeat, device))
+        report('precomputed graph', *timed(fused_query, opts.repeat, device))
+        print('max abs difference of the queries: {:.3e}'.format((legacy_query() - fused_query()).abs().max().item()))
+
+        validation_data = env.generate_data(opts.batch_size)
+        num_steps = validate()
+        ms, peak = timed(validate, opts.repeat, device)
+        print('{} decoding steps per greedy rollout'.format(num_steps))
+        report('rollout', ms, peak)
+        report('rollout, per step', ms / num_steps, peak)
+
+
+########################################
+# OP STEP
+########################################
+
+def legacy_op_feasibility(env, selected):
+    # the former OPEnv.step check: norms over the pomo-expanded coordinates at every step
+    cur_coord = env.coords[env.BATCH_IDX, env.POMO_IDX, selected, :]
+    next_step_len = env.length[:, :, None] + (env.coords - cur_coord[:, :, None, :]).norm(p=2, dim=-1)
+    depot_xy = env.depot_xy[:, None, ...].expand(env.batch_size, env.pomo_size, 1, -1)
+    next_step_backto_depot_len = next_step_len + (env.coords - depot_xy).norm(p=2, dim=-1)
+    return (next_step_len > env.max_length[:, :, None]) | (next_step_backto_depot_len > env.max_length[:, :, None])
+
+
+def cached_op_feasibility(env, selected):
+    next_step_len = env.length[:, :, None] + env.dist_matrix[env.BATCH_IDX, selected]
+    next_step_backto_depot_len = next_step_len + env.depot_dist[:, None, :]
+    return (next_step_len > env.max_length[:, :, None]) | (next_step_backto_depot_len > env.max_length[:, :, None])
+
+
+def bench_op_step(opts):
+    # env.step of random feasible OP rollouts, and the feasibility check alone at the middle of a rollout
+    device = torch.device(opts.device)
+
+    def sync():
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+
+    for problem_size in opts.problem_sizes:
+        _, env = load_model_env('OP', problem_size, device)
+        data = env.generate_data(opts.batch_size)
+
+        def run(stop=None):
+            # returns the time spent in env.step (ms) and the number of steps
+            torch.manual_seed(1234)
+            env.load_problems(opts.batch_size, prepare_dataset=data)
+            env.reset()
+            state, _, done = env.pre_step()
+            step_time, num_steps = 0., 0
+            while not done and num_steps != stop:
+                if state.selected_count == 0:
+                    selected = torch.zeros(size=state.BATCH_IDX.shape, dtype=torch.long)
+                elif state.selected_count == 1:
+                    selected = torch.arange(1, env.pomo_size + 1)[None, :].expand(state.BATCH_IDX.shape)
+                else:
+                    selected = torch.rand(size=state.mask.shape).masked_fill(state.mask, -1).argmax(dim=2)
+                sync()
+                s = time.time()
+                state, _, done = env.step(selected)
+                sync()
+                step_time += 1000 * (time.time() - s)
+                num_steps += 1
+            return step_time, num_steps
+
+        step_time, num_steps = run()
+        print('OP{} batch {}, {} steps'.format(problem_size, opts.batch_size, num_steps))
+        print('{:<24s} {:10.3f} ms'.format('env.step, per step', step_time / num_steps))
+
+        run(stop=num_steps // 2)
+        selected = env.current_node
+        report('norm feasibility', *timed(lambda: legacy_op_feasibility(env, selected), opts.repeat, device))
+        report('cached feasibility', *timed(lambda: cached_op_feasibility(env, selected), opts.repeat, device))
+        print('masks differ at {} entries'.format(
+            (legacy_op_feasibility(env, selected) != cached_op_feasibility(env, selected)).sum().item()))
+
+
+########################################
+# COMPACTION
+########################################
+
+def bench_compact(opts):
+    # greedy validation rollouts (the ones of the trainer and COPTester) with and without dropping the finished
+    # instances, aug_factor 8 as in COPTester
+    device = torch.device(opts.device)
+    model, env = load_model_env(opts.problem, opts.problem_size, device)
+    model.eval()
+    torch.manual_seed(1234)
+    validation_data = env.generate_data(opts.batch_size)
+
+    def validate(compact):
+        if opts.problem == 'KP':
+            env.load_problems(opts.batch_size, prepare_dataset=validation_data)
+        else:
+            env.load_problems(opts.batch_size, opts.aug_factor, prepare_dataset=validation_data)
+        reset_s, _, _ = env.reset()
+        state, reward, done = env.pre_step()
+        with torch.no_grad():
+            model.pre_forward_oneCOP(reset_s, opts.problem)
+            reward, _ = rollout(model, env, opts.problem, state, reward, done, compact)
+        return reward
+
+    print('{}{} batch {}, aug {}, greedy rollout'.format(opts.problem, opts.problem_size, opts.batch_size,
+                                                         opts.aug_factor))
+    reference = validate(None)
+    report('no compaction', *timed(lambda: validate(None), opts.repeat, device))
+    for compact in opts.thresholds:
+        report('compact at {:.2f}'.format(compact), *timed(lambda: validate(compact), opts.repeat, device))
+        print('{:<24s} {:10.3e}'.format('max abs reward diff', (validate(compact) - reference).abs().max().item()))
+
+
+########################################
+# PREFETCH
+########################################
+
+def bench_prefetch(opts):
+    # training steps with the instances generated at the start of each step, and generated in the background
+    # while the step before runs its forward and backward
+    device = torch.device(opts.device)
+    model, env = load_model_env(opts.problem, opts.problem_size, device)
+    model.train()
+    prefetcher = InstancePrefetcher(device)
+    load_time = []
+    step = [0]
+
+    def train_step(prefetch):
+        s = time.time()
+        if prefetch:
+            generated = prefetcher.get((step[0],), opts.batch_size)
+            prefetcher.put((step[0] + 1,), env.random_problems, opts.batch_size)
+            step[0] += 1
+        else:
+            generated = None
+        env.load_problems(opts.batch_size, generated=generated)
+        load_time.append(time.time() - s)
+        reset_s, _, _ = env.reset()
+        state, reward, done = env.pre_step()
+        model.pre_forward_oneCOP(reset_s, opts.problem)
+        reward, log_prob = rollout(model, env, opts.problem, state, reward, done)
+        advantage = reward - reward.float().mean(dim=1, keepdims=True)
+        loss = (-advantage * log_prob).mean()
+        model.zero_grad()
+        loss.backward()
+
+    print('{}{} batch {}, forward + backward'.format(opts.problem, opts.problem_size, opts.batch_size))
+    for name, prefetch in [('generated in the step', False), ('prefetched', True)]:
+        load_time.clear()
+        prefetcher.reset_stats()
+        report(name, *timed(lambda: train_step(prefetch), opts.repeat, device))
+        print('{:<24s} {:10.2f} ms'.format('  instance loading', 1000 * np.mean(load_time[1:])))
+    print('{:<24s} {:10.2f} ms'.format('  background generation', 1000 * prefetcher.generation_time / max(prefetcher.hits, 1)))
+    print('{:<24s} {:10.2f} ms'.format('  waited for it', 1000 * prefetcher.wait_time / max(prefetcher.hits, 1)))
+
+
+########################################
+# INFLUENCE
+########################################
+
+def legacy_influ_mat(gradient_info, scales_per_cop, device):
+    # the nested-loop Trainer.get_influ_mat the influence engine replaced, on gradient_info[arm][t] =
+    # [[grad_share, grad_head, grad_dec] or [], count]
+    num_arms = len(gradient_info)
+    M_similarity = torch.zeros((num_arms, num_arms), device=device)
+    M_similarity_share = torch.zeros((num_arms, num_arms), device=device)
+    M_similarity_head = torch.zeros((num_arms, num_arms), device=device)
+    M_similarity_dec = torch.zeros((num_arms, num_arms), device=device)
+
+    def cos(a, b):
+        return (a * b).sum() / (torch.linalg.vector_norm(a) * torch.linalg.vector_norm(b))
+
+    cum_scales_per_cop = np.cumsum(scales_per_cop)
+    intervals = len(gradient_info[0])
+    for i in range(num_arms):
+        cop_i = np.where((i < cum_scales_per_cop) == True)[0][0]
+        grad_i = gradient_info[i]
+        for j in range(num_arms):
+            grad_j = gradient_info[j]
+            count_j = grad_j[intervals - 1][1]
+            if count_j == 0:
+                continue
+            cop_j = np.where((j < cum_scales_per_cop) == True)[0][0]
+            temp_all_sim, temp_share_sim, temp_header_sim, temp_dec_sim = 0, 0, 0, 0
+            for t in range(intervals):
+                # the last gradient of i at step t
+                latest_i = None
+                for temp in range(t, -1, -1):
+                    if len(grad_i[temp][0]) != 0:
+                        latest_i = grad_i[temp][0]
+                        break
+                if len(grad_j[t][0]) != 0 and latest_i is not None:
+                    latest_j = grad_j[t][0]
+                    temp_share_sim += cos(latest_i[0], latest_j[0])
+                    if cop_i == cop_j:
+                        temp_all_sim += cos(torch.cat(latest_i), torch.cat(latest_j))
+                        temp_header_sim += cos(latest_i[1], latest_j[1])
+                        temp_dec_sim += cos(latest_i[2], latest_j[2])
+            M_similarity_share[i, j] = temp_share_sim / count_j
+            if cop_i == cop_j:
+                M_similarity[i, j] = temp_all_sim / count_j
+                M_similarity_head[i, j] = temp_header_sim / count_j
+                M_similarity_dec[i, j] = temp_dec_sim / count_j
+            else:
+                M_similarity[i, j] = temp_share_sim / count_j
+    return M_similarity.cpu().numpy(), M_similarity_share.cpu().numpy(), M_similarity_head.cpu().numpy(), \
+        M_similarity_dec.cpu().numpy()
+
+
+def random_gradient_info(scales_per_cop, dims, select_freq, carried, generator):
+    # one window of the former gradient_info with a random arm per step, carried: every arm has a gradient at
+    # step 0 from the window before, as after the warm-start window. a window with no carried gradient only
+    # starts at step 0 for all the arms at once (the first window)
+    arm_cop = [cop for cop, num in enumerate(scales_per_cop) for _ in range(num)]
+    num_arms = len(arm_cop)
+
+    def grads(arm):
+        share_dim, head_dims, dec_dims = dims
+        cop = arm_cop[arm]
+        return [torch.randn(share_dim, generator=generator), torch.randn(head_dims[cop], generator=generator),
+                torch.randn(dec_dims[cop], generator=generator)]
+
+    gradient_info = {arm: {} for arm in range(num_arms)}
+    counts = np.zeros(num_arms, dtype=int)
+    if carried:
+        for arm in range(num_arms):
+            gradient_info[arm][0] = [grads(arm), 1]
+            counts[arm] = 1
+    for _ in range(select_freq):
+        choice = torch.randint(num_arms, (1,), generator=generator).item()
+        counts[choice] += 1
+        for arm in range(num_arms):
+            gradient_info[arm][len(gradient_info[arm])] = [grads(arm) if arm == choice else [], counts[arm]]
+    return gradient_info, arm_cop
+
+
+def bench_influence(opts):
+    # the vectorized influence engine (GradientStore, SimilarityAccumulator) against the nested-loop one, on random
+    # gradients: maximum absolute difference of the four matrices and time of each
+    from influence import GradientStore, SimilarityAccumulator
+    device = torch.device(opts.device)
+    generator = torch.Generator().manual_seed(opts.seed)
+    dims = (opts.share_dim, [opts.head_dim] * len(opts.scales_per_cop), [opts.dec_dim] * len(opts.scales_per_cop))
+    names = ['all', 'share', 'head', 'dec']
+    for carried in [False, True]:
+        gradient_info, arm_cop = random_gradient_info(opts.scales_per_cop, dims, opts.select_freq, carried, generator)
+        gradient_info = {arm: {t: [[g.to(device) for g in val[0]], val[1]] for t, val in info.items()}
+                         for arm, info in gradient_info.items()}
+        num_arms = len(arm_cop)
+
+        def engine(store_cls, **kwargs):
+            store = store_cls(num_arms, share_dim=dims[0], head_dims=dims[1], dec_dims=dims[2], arm_cop=arm_cop,
+                              device=device, **kwargs)
+            store.load_gradient_info(gradient_info)
+            return store.influence()
+
+        runs = [('nested loops', lambda: legacy_influ_mat(gradient_info, opts.scales_per_cop, device)),
+                ('GradientStore', lambda: engine(GradientStore, capacity=opts.select_freq)),
+                ('SimilarityAccumulator', lambda: engine(SimilarityAccumulator))]
+        print('{} arms, window of {} steps, {} carried gradients'
+              .format(num_arms, opts.select_freq, 'with' if carried else 'no'))
+        reference = runs[0][1]()
+        for name, fn in runs:
+            report(name, *timed(fn, opts.repeat, device))
+            if fn is not runs[0][1]:
+                diff = [np.abs(a - b).max() for a, b in zip(fn(), reference)]
+                print('  max abs difference     ' + '  '.join('{} {:.2e}'.format(n, d) for n, d in zip(names, diff)))
+                assert max(diff) < opts.atol, '{} differs from the nested loops'.format(name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--repeat', type=int, default=10)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    sub = subparsers.add_parser('rollout', help='running log-probability sum and two-phase rollout against the '
+                                                'concatenated prob_list')
+    sub.add_argument('--problem', default='CVRP', choices=['TSP', 'CVRP', 'OP', 'KP'])
+    sub.add_argument('--problem_size', type=int, default=100)
+    sub.add_argument('--batch_size', type=int, default=64)
+    sub.set_defaults(func=bench_rollout)
+
+    sub = subparsers.add_parser('amp', help='mixed precision against fp32: step time, memory and validation gap')
+    sub.add_argument('--problem', default='CVRP', choices=['TSP', 'CVRP', 'OP', 'KP'])
+    sub.add_argument('--problem_size', type=int, default=100)
+    sub.add_argument('--batch_size', type=int, default=64)
+    sub.add_argument('--evaluation_size', type=int, default=1024)
+    sub.set_defaults(func=bench_amp)
+
+    sub = subparsers.add_parser('attention', help='fused scaled_dot_product_attention against the reference attention')
+    sub.add_argument('--problem', default='TSP', choices=['TSP', 'CVRP', 'OP', 'KP'])
+    sub.add_argument('--problem_size', type=int, default=100)
+    sub.add_argument('--batch_size', type=int, default=64)
+    sub.set_defaults(func=bench_attention)
+
+    sub = subparsers.add_parser('kp_query', help='KP decoder query from the precomputed graph projection against the '
+                                                 'full Wq projection')
+    sub.add_argument('--problem_size', type=int, default=200)
+    sub.add_argument('--batch_size', type=int, default=64)
+    sub.set_defaults(func=bench_kp_query)
+
+    sub = subparsers.add_parser('op_step', help='OP env step with the cached distance matrix')
+    sub.add_argument('--problem_sizes', nargs='+', type=int, default=[50, 100])
+    sub.add_argument('--batch_size', type=int, default=64)
+    sub.set_defaults(func=bench_op_step)
+
+    sub = subparsers.add_parser('compact', help='validation rollouts that drop the finished instances')
+    sub.add_argument('--problem', default='CVRP', choices=['CVRP', 'OP', 'KP'])
+    sub.add_argument('--problem_size', type=int, default=100)
+    sub.add_argument('--batch_size', type=int, default=1024)
+    sub.add_argument('--aug_factor', type=int, default=1, choices=[1, 8])
+    sub.add_argument('--thresholds', nargs='+', type=float, default=[0.1, 0.25, 0.5])
+    sub.set_defaults(func=bench_compact)
+
+    sub = subparsers.add_parser('prefetch', help='random instances generated in the background during the step '
+                                                 'before')
+    sub.add_argument('--problem', default='CVRP', choices=['TSP', 'CVRP', 'OP', 'KP'])
+    sub.add_argument('--problem_size', type=int, default=100)
+    sub.add_argument('--batch_size', type=int, default=64)
+    sub.set_defaults(func=bench_prefetch)
+
+    sub = subparsers.add_parser('influence', help='vectorized influence matrices against the nested loops they '
+                                                  'replaced, on random gradients')
+    sub.add_argument('--scales_per_cop', nargs='+', type=int, default=[3, 3, 3, 3])
+    sub.add_argument('--select_freq', type=int, default=12)
+    sub.add_argument('--share_dim', type=int, default=4096)
+    sub.add_argument('--head_dim', type=int, default=512)
+    sub.add_argument('--dec_dim', type=int, default=1024)
+    sub.add_argument('--seed', type=int, default=0)
+    sub.add_argument('--atol', type=float, default=1e-5)
+    sub.set_defaults(func=bench_influence)
+
+    opts = parser.parse_args()
+    opts.func(opts)
@@ -0,0 +1,577 @@
+import copy
+import torch
+import torch.distributed as dist
+import numpy as np
+
+
+def rows_from_gradient_info(gradient_info):
+    # gradient_info[arm][t] = [[grad_share, grad_head, grad_dec] or [], count]
+    # flatten into one row per recorded gradient, ordered by (t, arm)
+    arms, times, grad_share, grad_head, grad_dec = [], [], [], [], []
+    intervals = max([len(val) for val in gradient_info.values()] + [0])
+    for t in range(intervals):
+        for arm in range(len(gradient_info)):
+            if t < len(gradient_info[arm]) and len(gradient_info[arm][t][0]) != 0:
+                share, head, dec = gradient_info[arm][t][0]
+                arms.append(arm)
+                times.append(t)
+                grad_share.append(share)
+                grad_head.append(head)
+                grad_dec.append(dec)
+    return arms, times, grad_share, grad_head, grad_dec
+
+
+def _cosine(gram):
+    norm = gram.diagonal().sqrt()
+    return gram / (norm[:, None] * norm[None, :])
+
+
+def influence_from_gram(gram_share, gram_head, gram_dec, arms, times, arm_cop, num_arms):
+    # arms, times: (rows,) arm index and window step of every recorded gradient, in chronological order
+    # for each pair (i, j) sums, over the steps where j has a gradient, the cosine between j's gradient and
+    # the last available gradient of i at that step, then divides by the number of gradients of j
+    device = gram_share.device
+    num_rows = gram_share.size(0)
+    M_shape = (num_arms, num_arms)
+    if num_rows == 0:
+        return tuple(np.zeros(M_shape, dtype=np.float32) for _ in range(4))
+
+    arms = torch.as_tensor(arms, dtype=torch.long, device=device)
+    times = torch.as_tensor(times, dtype=torch.long, device=device)
+    arm_cop = torch.as_tensor(arm_cop, dtype=torch.long, device=device)
+
+    cos_share = _cosine(gram_share)
+    cos_head = _cosine(gram_head)
+    cos_dec = _cosine(gram_dec)
+    cos_all = _cosine(gram_share + gram_head + gram_dec)
+    # shape: (rows, rows)
+
+    row_idx = torch.arange(num_rows, device=device)
+    is_arm = arms[None, :] == torch.arange(num_arms, device=device)[:, None]
+    # shape: (arm, rows)
+    not_later = times[None, :] <= times[:, None]
+    # shape: (rows, rows), [r, s] = s is recorded no later than r
+    candidate = is_arm[:, None, :] & not_later[None, :, :]
+    # shape: (arm, rows, rows)
+    last = torch.where(candidate, row_idx, -1).max(dim=2)[0]
+    # shape: (arm, rows), forward-filled row of each arm at the step of each row, -1 if none yet
+    available = last >= 0
+    last = last.clamp(min=0)
+
+    counts = is_arm.sum(dim=1)
+    same_cop = arm_cop[:, None] == arm_cop[None, :]
+    # shape: (arm, arm)
+
+    def window_mean(cos):
+        sim = torch.where(available, cos[last, row_idx[None, :]], torch.zeros((), device=device))
+        # shape: (arm, rows)
+        total = sim @ is_arm.T.to(sim.dtype)
+        # shape: (arm, arm)
+        return torch.where(counts[None, :] > 0, total / counts[None, :].clamp(min=1), torch.zeros((), device=device))
+
+    M_similarity_share = window_mean(cos_share)
+    zero = torch.zeros((), device=device)
+    M_similarity = torch.where(same_cop, window_mean(cos_all), M_similarity_share)
+    M_similarity_head = torch.where(same_cop, window_mean(cos_head), zero)
+    M_similarity_dec = torch.where(same_cop, window_mean(cos_dec), zero)
+    return M_similarity.cpu().numpy(), M_similarity_share.cpu().numpy(), \
+        M_similarity_head.cpu().numpy(), M_similarity_dec.cpu().numpy()
+
+
+def _copy_flat(dst, src, offset=0):
+    # copies src[offset:offset + len(dst)] into dst, zero padded past the end of src
+    # src: flat tensor, or a sequence of tensors (e.g. parameter gradients) laid out back to back
+    tensors = [src] if torch.is_tensor(src) else src
+    start = 0
+    end = offset + dst.numel()
+    for tensor in tensors:
+        numel = tensor.numel()
+        lo, hi = max(start, offset), min(start + numel, end)
+        if lo < hi:
+            dst[lo - offset:hi - offset].copy_(tensor.reshape(-1)[lo - start:hi - start])
+        start += numel
+    if start < end:
+        dst[max(start - offset, 0):].zero_()
+
+
+class GradientShard:
+    # Splits every flat parameter-group gradient into world_size contiguous slices of equal width (the last one
+    # zero padded), each rank keeps its own slice. Dot products are sums of the partial dot products of the slices,
+    # so the stores below all-reduce their Gram matrices over the group instead of holding whole gradients.
+    def __init__(self, share_dim, head_dims, dec_dims, rank, world_size, group=None):
+        self.rank = rank
+        self.world_size = world_size
+        self.group = group
+        self.share_dim = -(-share_dim // world_size)
+        self.head_dims = [-(-dim // world_size) for dim in head_dims]
+        self.dec_dims = [-(-dim // world_size) for dim in dec_dims]
+
+    def _slice(self, grad, width):
+        device = grad.device if torch.is_tensor(grad) else grad[0].device
+        out = torch.empty(width, device=device)
+        _copy_flat(out, grad, self.rank * width)
+        return out
+
+    def __call__(self, cop, grad_share, grad_head, grad_dec):
+        return self._slice(grad_share, self.share_dim), self._slice(grad_head, self.head_dims[cop]), \
+            self._slice(grad_dec, self.dec_dims[cop])
+
+    def all_reduce(self, tensor):
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM, group=self.group)
+        return tensor
+
+    def all_gather(self, rows):
+        # rows: (n, width) local slices, returns the (n, world_size * width) whole rows
+        gathered = [torch.empty_like(rows) for _ in range(self.world_size)]
+        dist.all_gather(gathered, rows.contiguous(), group=self.group)
+        return torch.cat(gathered, dim=1)
+
+
+def _gather_rows(buffer, slots, shard=None):
+    rows = buffer[torch.as_tensor(slots, dtype=torch.long, device=buffer.device)]
+    if shard is not None:
+        rows = shard.all_gather(rows)
+    return rows.cpu()
+
+
+class GradientStore:
+    # Preallocated storage of the gradients recorded in one bandit selection window.
+    # Every parameter group has one buffer of shape (num_arms + capacity, D):
+    # rows [0, num_arms) carry the last gradient of each arm from the previous windows (window step 0),
+    # rows [num_arms, num_arms + capacity) hold the gradients recorded in the current window.
+    # The buffers are a ring: in a window longer than capacity (the warm-start one) the oldest gradient of the window
+    # is folded into the carried row of its arm, so that window is summarized by fewer gradients than it recorded.
+    # Without fixed, such a window doubles the buffers instead, which shrink back at the next reset.
+    # Header and decoder buffers are kept per COP, since their sizes differ between problems.
+    # With a GradientShard the buffers hold this rank's slice of every gradient.
+    # swap hands the buffers of a finished window over to a GradientWindow and continues in a second set of buffers.
+    def __init__(self, num_arms, capacity, share_dim, head_dims, dec_dims, arm_cop, device=None, dtype=torch.float32,
+                 shard=None, fixed=True):
+        self.num_arms = num_arms
+        self.capacity = capacity
+        self.base_capacity = capacity
+        self.fixed = fixed
+        self.arm_cop = np.asarray(arm_cop, dtype=int)
+        self.shard = shard
+        num_slots = num_arms + capacity
+
+        self.share = torch.zeros((num_slots, share_dim), device=device, dtype=dtype)
+        self.head = [torch.zeros((num_slots, dim), device=device, dtype=dtype) for dim in head_dims]
+        self.dec = [torch.zeros((num_slots, dim), device=device, dtype=dtype) for dim in dec_dims]
+
+        self.slot_arm = np.full(num_slots, -1, dtype=int)
+        self.slot_time = np.zeros(num_slots, dtype=int)
+        self.step = 0
+        self.cursor = 0
+        self.spare = None
+        # the buffers of the window handed over by the last swap, reused by the next one
+
+    def _write(self, slot, arm, grad_share, grad_head, grad_dec, whole=False):
+        # whole: the gradients are whole rows (e.g. from a checkpoint) of which only this shard's slice is kept
+        cop = self.arm_cop[arm]
+        for buffer, grad in ((self.share, grad_share), (self.head[cop], grad_head), (self.dec[cop], grad_dec)):
+            offset = self.shard.rank * buffer.size(1) if whole and self.shard is not None else 0
+            _copy_flat(buffer[slot], grad, offset)
+
+    def _carry(self, arm, slot, source=None):
+        # source: the (share, head, dec) buffers the slot is in, these ones by default
+        share, head, dec = (self.share, self.head, self.dec) if source is None else source
+        cop = self.arm_cop[arm]
+        self.share[arm].copy_(share[slot])
+        self.head[cop][arm].copy_(head[cop][slot])
+        self.dec[cop][arm].copy_(dec[cop][slot])
+        self.slot_arm[arm] = arm
+        self.slot_time[arm] = 0
+
+    def _resize(self, capacity):
+        # keeps the first rows, i.e. the carried ones and the recorded ones when growing
+        num_slots = self.num_arms + capacity
+        rows = min(num_slots, self.share.size(0))
+
+        def resized(buffer):
+            out = buffer.new_zeros((num_slots, buffer.size(1)))
+            out[:rows] = buffer[:rows]
+            return out
+        self.share = resized(self.share)
+        self.head = [resized(head) for head in self.head]
+        self.dec = [resized(dec) for dec in self.dec]
+        slot_arm = np.full(num_slots, -1, dtype=int)
+        slot_time = np.zeros(num_slots, dtype=int)
+        slot_arm[:rows] = self.slot_arm[:rows]
+        slot_time[:rows] = self.slot_time[:rows]
+        self.slot_arm, self.slot_time = slot_arm, slot_time
+        self.capacity = capacity
+
+    def append(self, arm, grad_share, grad_head, grad_dec, whole=False):
+        arm = int(arm)
+        slot = self.num_arms + self.cursor
+        evicted = self.slot_arm[slot]
+        if evicted >= 0 and not self.fixed:
+            # the window is longer than the buffers, they are full and have not wrapped around
+            self.cursor = self.capacity
+            self._resize(2 * self.capacity)
+            slot = self.num_arms + self.cursor
+        elif evicted >= 0:
+            # the window is longer than the ring, the oldest gradient is kept as the carried one of its arm
+            self._carry(evicted, slot)
+        self._write(slot, arm, grad_share, grad_head, grad_dec, whole)
+        self.slot_arm[slot] = arm
+        self.slot_time[slot] = self.step + 1
+        self.step += 1
+        self.cursor = (self.cursor + 1) % self.capacity
+
+    def set_carry(self, arm, grad_share, grad_head, grad_dec, whole=False):
+        arm = int(arm)
+        self._write(arm, arm, grad_share, grad_head, grad_dec, whole)
+        self.slot_arm[arm] = arm
+        self.slot_time[arm] = 0
+
+    def reset(self, source=None):
+        # start a new window, the latest gradient of each arm becomes its carried gradient
+        # source: the buffers of the finished window when they were swapped out
+        ring = np.arange(self.num_arms, self.num_arms + self.capacity)
+        for arm in range(self.num_arms):
+            slots = ring[self.slot_arm[ring] == arm]
+            if len(slots) > 0:
+                self._carry(arm, slots[np.argmax(self.slot_time[slots])], source)
+            elif source is not None and self.slot_arm[arm] >= 0:
+                self._carry(arm, arm, source)
+        self.slot_arm[ring] = -1
+        self.step = 0
+        self.cursor = 0
+        if self.capacity > self.base_capacity:
+            self._resize(self.base_capacity)
+
+    def swap(self):
+        # hands the buffers of the current window over to a GradientWindow, whose Gram matrices can then be computed
+        # while the next window is recorded, and starts the next window in the spare buffers.
+        # the GradientWindow of the previous swap must no longer be in use, its buffers become the spare ones
+        window = GradientWindow(self.share, self.head, self.dec, *self.rows(), arm_cop=self.arm_cop,
+                                num_arms=self.num_arms, shard=self.shard)
+        source = (self.share, self.head, self.dec)
+        if self.spare is not None and self.spare[0].shape == self.share.shape:
+            self.share, self.head, self.dec = self.spare
+        else:
+            self.share = torch.zeros_like(self.share)
+            self.head = [torch.zeros_like(head) for head in self.head]
+            self.dec = [torch.zeros_like(dec) for dec in self.dec]
+        self.spare = source
+        self.reset(source)
+        return window
+
+    def rows(self):
+        slots = np.where(self.slot_arm >= 0)[0]
+        slots = slots[np.argsort(self.slot_time[slots], kind='stable')]
+        return slots, self.slot_arm[slots], self.slot_time[slots]
+
+    def counts(self):
+        return np.bincount(self.slot_arm[self.slot_arm >= 0], minlength=self.num_arms)
+
+    def reduced(self):
+        # the all-reduced Gram matrices of the current window, the collectives run on the calling thread
+        slots, arms, times = self.rows()
+        window = ReducedWindow(*_local_gram(self.share, self.head, self.dec, slots, arms, self.arm_cop), arms, times,
+                               self.arm_cop, self.num_arms)
+        return window.all_reduce(self.shard)
+
+    def influence(self):
+        return self.reduced().influence()
+
+    def state_dict(self):
+        # sharded stores gather the whole rows, so this has to be called on every rank of the group
+        slots, arms, times = self.rows()
+        state = {'arms': arms, 'times': times, 'share': _gather_rows(self.share, slots, self.shard),
+                 'head': [None] * len(slots), 'dec': [None] * len(slots)}
+        row_cop = self.arm_cop[arms]
+        for cop in np.unique(row_cop):
+            rows = np.where(row_cop == cop)[0]
+            for key, buffer in (('head', self.head[cop]), ('dec', self.dec[cop])):
+                for r, grad in zip(rows, _gather_rows(buffer, slots[rows], self.shard)):
+                    state[key][r] = grad
+        return state
+
+    def load_state_dict(self, state):
+        # replay the saved rows, so the capacity may differ from the one they were saved with
+        self.slot_arm[:] = -1
+        self.step = 0
+        self.cursor = 0
+        for r, (arm, time) in enumerate(zip(state['arms'], state['times'])):
+            grads = (state['share'][r], state['head'][r], state['dec'][r])
+            if time == 0:
+                self.set_carry(arm, *grads, whole=True)
+            else:
+                self.append(arm, *grads, whole=True)
+
+    def load_gradient_info(self, gradient_info):
+        # gradient_info: the dict of lists used by earlier checkpoints
+        arms, times, grad_share, grad_head, grad_dec = rows_from_gradient_info(gradient_info)
+        self.load_state_dict({'arms': arms, 'times': times, 'share': grad_share, 'head': grad_head, 'dec': grad_dec})
+
+
+def _local_gram(share, head, dec, slots, arms, arm_cop):
+    # Gram matrices of the rows of the slots, of this rank's slices with a GradientShard
+    idx = torch.as_tensor(slots, dtype=torch.long, device=share.device)
+    gram_share = (share @ share.T)[idx[:, None], idx[None, :]]
+    gram_head = torch.zeros_like(gram_share)
+    gram_dec = torch.zeros_like(gram_share)
+    # shape: (rows, rows)
+
+    row_cop = arm_cop[arms]
+    for cop in np.unique(row_cop):
+        rows = torch.as_tensor(np.where(row_cop == cop)[0], dtype=torch.long, device=idx.device)
+        cop_slots = idx[rows]
+        gram_head[rows[:, None], rows[None, :]] = (head[cop] @ head[cop].T)[cop_slots[:, None], cop_slots[None, :]]
+        gram_dec[rows[:, None], rows[None, :]] = (dec[cop] @ dec[cop].T)[cop_slots[:, None], cop_slots[None, :]]
+    return gram_share, gram_head, gram_dec
+
+
+class GradientWindow:
+    # The buffers of a finished GradientStore window, see GradientStore.swap. local computes the Gram matrices of
+    # this rank's buffers with no collective, so it can run on a background thread. With a GradientShard they are
+    # partial sums, which the caller all-reduces (ReducedWindow.all_reduce) on the training thread.
+    def __init__(self, share, head, dec, slots, arms, times, arm_cop, num_arms, shard=None):
+        self.share = share
+        self.head = head
+        self.dec = dec
+        self.slots = slots
+        self.arms = arms
+        self.times = times
+        self.arm_cop = arm_cop
+        self.num_arms = num_arms
+        self.shard = shard
+
+    def local(self):
+        return ReducedWindow(*_local_gram(self.share, self.head, self.dec, self.slots, self.arms, self.arm_cop),
+                             self.arms, self.times, self.arm_cop, self.num_arms)
+
+    def counts(self):
+        return np.bincount(self.arms, minlength=self.num_arms)
+
+    def influence(self):
+        if self.shard is not None:
+            raise RuntimeError('the Gram matrices of a sharded window need an all-reduce, use local and all_reduce')
+        return self.local().influence()
+
+
+class ReducedWindow:
+    # Gram matrices of a GradientStore window, all-reduced over the ranks by all_reduce when the store is sharded.
+    # influence and counts need no collective, so they can run on a background thread while the store records the
+    # next window.
+    def __init__(self, gram_share, gram_head, gram_dec, arms, times, arm_cop, num_arms):
+        self.gram_share = gram_share
+        self.gram_head = gram_head
+        self.gram_dec = gram_dec
+        self.arms = arms
+        self.times = times
+        self.arm_cop = arm_cop
+        self.num_arms = num_arms
+
+    def all_reduce(self, shard=None):
+        # sums the partial Gram matrices of the shards, one (3, rows, rows) all-reduce
+        if shard is not None:
+            gram = shard.all_reduce(torch.stack((self.gram_share, self.gram_head, self.gram_dec)))
+            self.gram_share, self.gram_head, self.gram_dec = gram[0], gram[1], gram[2]
+        return self
+
+    def counts(self):
+        return np.bincount(self.arms, minlength=self.num_arms)
+
+    def influence(self):
+        return influence_from_gram(self.gram_share, self.gram_head, self.gram_dec, self.arms, self.times,
+                                   self.arm_cop, self.num_arms)
+
+
+class SimilarityAccumulator:
+    # Streaming alternative to GradientStore: only the last gradient of each arm is kept, and the window sums of
+    # cosine similarities are updated as every gradient arrives, so memory does not depend on the window length
+    # and reading the window matrices at the end is a division.
+    # With a GradientShard the partial dot products of every step are all-reduced over the group.
+    def __init__(self, num_arms, share_dim, head_dims, dec_dims, arm_cop, device=None, dtype=torch.float32,
+                 shard=None):
+        self.num_arms = num_arms
+        self.arm_cop = np.asarray(arm_cop, dtype=int)
+        self.shard = shard
+
+        self.share = torch.zeros((num_arms, share_dim), device=device, dtype=dtype)
+        self.head = [torch.zeros((num_arms, dim), device=device, dtype=dtype) for dim in head_dims]
+        self.dec = [torch.zeros((num_arms, dim), device=device, dtype=dtype) for dim in dec_dims]
+        self.sq_norm = torch.zeros((3, num_arms), device=device, dtype=dtype)
+        # shape: (share/head/dec, arm)
+        self.valid = np.zeros(num_arms, dtype=bool)
+
+        self.sums = torch.zeros((4, num_arms, num_arms), device=device, dtype=dtype)
+        # shape: (all/share/head/dec, arm, arm)
+        self.num_grads = np.zeros(num_arms, dtype=int)
+        self.same_cop = torch.as_tensor(self.arm_cop[:, None] == self.arm_cop[None, :], device=self.share.device)
+
+    def _set_latest(self, arm, grad_share, grad_head, grad_dec, whole=False):
+        cop = self.arm_cop[arm]
+        for buffer, grad in ((self.share, grad_share), (self.head[cop], grad_head), (self.dec[cop], grad_dec)):
+            offset = self.shard.rank * buffer.size(1) if whole and self.shard is not None else 0
+            _copy_flat(buffer[arm], grad, offset)
+        self.valid[arm] = True
+
+    def _update_norms(self):
+        sq_norm = torch.stack([(self.share ** 2).sum(dim=1),
+                               sum((head ** 2).sum(dim=1) for head in self.head),
+                               sum((dec ** 2).sum(dim=1) for dec in self.dec)])
+        # shape: (share/head/dec, arm), the rows of an arm are zero in the buffers of the other COPs
+        self.sq_norm = sq_norm if self.shard is None else self.shard.all_reduce(sq_norm)
+
+    def append(self, arm, grad_share, grad_head, grad_dec):
+        arm = int(arm)
+        self._set_latest(arm, grad_share, grad_head, grad_dec)
+        self._append_latest(arm)
+
+    def _append_latest(self, arm):
+        cop = self.arm_cop[arm]
+        dots = torch.stack([self.share @ self.share[arm],
+                            self.head[cop] @ self.head[cop][arm],
+                            self.dec[cop] @ self.dec[cop][arm]])
+        # shape: (share/head/dec, arm), arms of other COPs have zero header/decoder rows in this COP's buffers
+        if self.shard is not None:
+            self.shard.all_reduce(dots)
+        self.sq_norm[:, arm] = dots[:, arm]
+        sq_norm = self.sq_norm
+        cos = dots / (sq_norm * sq_norm[:, arm:arm + 1]).sqrt()
+        cos_all = dots.sum(dim=0) / (sq_norm.sum(dim=0) * sq_norm[:, arm].sum()).sqrt()
+        cos = torch.cat((cos_all[None], cos), dim=0)
+        # shape: (all/share/head/dec, arm)
+
+        available = torch.as_tensor(self.valid, device=cos.device)
+        same = self.same_cop[:, arm]
+        keep = torch.stack((available & same, available, available & same, available & same))
+        self.sums[:, :, arm] += torch.where(keep, cos, torch.zeros((), device=cos.device))
+        self.num_grads[arm] += 1
+
+    def reset(self):
+        # start a new window, the latest gradient of every arm is counted once at its first step
+        gram = torch.zeros((3, self.num_arms, self.num_arms), device=self.share.device, dtype=self.share.dtype)
+        gram[0] = self.share @ self.share.T
+        for cop in np.unique(self.arm_cop):
+            rows = torch.as_tensor(np.where(self.arm_cop == cop)[0], dtype=torch.long, device=gram.device)
+            gram[1][rows[:, None], rows[None, :]] = (self.head[cop] @ self.head[cop].T)[rows[:, None], rows[None, :]]
+            gram[2][rows[:, None], rows[None, :]] = (self.dec[cop] @ self.dec[cop].T)[rows[:, None], rows[None, :]]
+        if self.shard is not None:
+            self.shard.all_reduce(gram)
+        cos = torch.stack((_cosine(gram.sum(dim=0)), _cosine(gram[0]), _cosine(gram[1]), _cosine(gram[2])))
+
+        valid = torch.as_tensor(self.valid, device=gram.device)
+        available = valid[:, None] & valid[None, :]
+        keep = torch.stack((available & self.same_cop, available, available & self.same_cop, available & self.same_cop))
+        self.sums = torch.where(keep, cos, torch.zeros((), device=gram.device))
+        self.num_grads = self.valid.astype(int)
+
+    def counts(self):
+        return self.num_grads.copy()
+
+    def reduced(self):
+        # copy of the window sums, which are already all-reduced. the gradient buffers are shared since the
+        # influence matrix does not read them
+        accumulator = copy.copy(self)
+        accumulator.sums = self.sums.clone()
+        accumulator.num_grads = self.num_grads.copy()
+        return accumulator
+
+    def influence(self):
+        counts = torch.as_tensor(self.num_grads, device=self.sums.device)
+        M = torch.where(counts[None, None, :] > 0, self.sums / counts.clamp(min=1), torch.zeros((), device=self.sums.device))
+        M_similarity = torch.where(self.same_cop, M[0], M[1])
+        return M_similarity.cpu().numpy(), M[1].cpu().numpy(), M[2].cpu().numpy(), M[3].cpu().numpy()
+
+    def state_dict(self):
+        # sharded accumulators gather the whole rows, so this has to be called on every rank of the group
+        arms = np.where(self.valid)[0]
+        head, dec = [None] * len(arms), [None] * len(arms)
+        row_cop = self.arm_cop[arms]
+        for cop in np.unique(row_cop):
+            rows = np.where(row_cop == cop)[0]
+            for grads, buffer in ((head, self.head[cop]), (dec, self.dec[cop])):
+                for r, grad in zip(rows, _gather_rows(buffer, arms[rows], self.shard)):
+                    grads[r] = grad
+        return {'arms': arms, 'times': np.zeros(len(arms), dtype=int),
+                'share': _gather_rows(self.share, arms, self.shard), 'head': head, 'dec': dec,
+                'sums': self.sums.cpu(), 'counts': self.num_grads.copy()}
+
+    def load_state_dict(self, state):
+        # accepts its own state, or the rows saved by GradientStore which are replayed
+        self.valid[:] = False
+        rows = list(zip(state['arms'], state['times']))
+        for r, (arm, time) in enumerate(rows):
+            if time == 0:
+                self._set_latest(int(arm), state['share'][r], state['head'][r], state['dec'][r], whole=True)
+        self._update_norms()
+        if 'sums' in state:
+            self.sums = state['sums'].to(self.sums.device)
+            self.num_grads = np.asarray(state['counts'], dtype=int)
+            return
+        self.reset()
+        for r, (arm, time) in enumerate(rows):
+            if time != 0:
+                arm = int(arm)
+                self._set_latest(arm, state['share'][r], state['head'][r], state['dec'][r], whole=True)
+                self._append_latest(arm)
+
+    def load_gradient_info(self, gradient_info):
+        arms, times, grad_share, grad_head, grad_dec = rows_from_gradient_info(gradient_info)
+        self.load_state_dict({'arms': arms, 'times': times, 'share': grad_share, 'head': grad_head, 'dec': grad_dec})
+
+
+class GradientSketch:
+    # Seeded random projection of a flat gradient of size dim down to k dimensions, dot products are preserved in
+    # expectation. The gaussian/rademacher matrices are regenerated chunk by chunk instead of being kept in memory,
+    # the count sketch only keeps a bucket (int32) and a sign (bool) per coordinate, 5 bytes.
+    def __init__(self, dim, k, kind='countsketch', seed=0, device=None, chunk_size=1 << 16):
+        self.dim = dim
+        self.k = k
+        self.kind = kind
+        self.seed = seed
+        self.device = device
+        self.chunk_size = chunk_size
+        if kind == 'countsketch':
+            generator = torch.Generator(device=device)
+            generator.manual_seed(seed)
+            self.bucket = torch.randint(0, k, (dim,), generator=generator, device=device).int()
+            self.negative = torch.randint(0, 2, (dim,), generator=generator, device=device) == 0
+            # the same draws as the former int64 bucket and +-1 sign, so saved sketches stay comparable
+        elif kind not in ['gaussian', 'rademacher']:
+            raise NotImplementedError
+
+    def _projection(self, chunk, rows, generator):
+        generator.manual_seed(self.seed * 1000003 + chunk)
+        if self.kind == 'gaussian':
+            return torch.randn((rows, self.k), generator=generator, device=self.device)
+        return torch.randint(0, 2, (rows, self.k), generator=generator, device=self.device).float() * 2 - 1
+
+    def __call__(self, grad):
+        grad = grad if torch.is_tensor(grad) else torch.cat([g.reshape(-1) for g in grad])
+        if self.kind == 'countsketch':
+            return torch.zeros(self.k, device=grad.device, dtype=grad.dtype).index_add_(
+                0, self.bucket, torch.where(self.negative, -grad, grad))
+        sketch = torch.zeros(self.k, device=grad.device, dtype=grad.dtype)
+        generator = torch.Generator(device=self.device)
+        for chunk, start in enumerate(range(0, self.dim, self.chunk_size)):
+            part = grad[start:start + self.chunk_size]
+            sketch += part @ self._projection(chunk, part.numel(), generator).to(grad.dtype)
+        return sketch / self.k ** .5
+
+
+class GradientSketcher:
+    # one GradientSketch per parameter group, groups that are already at most k long are stored as they are
+    def __init__(self, share_dim, head_dims, dec_dims, k, kind='countsketch', seed=0, device=None):
+        def make(dim, group_seed):
+            return GradientSketch(dim, k, kind, group_seed, device) if dim > k else None
+        self.share = make(share_dim, seed)
+        self.head = [make(dim, seed + 1 + i) for i, dim in enumerate(head_dims)]
+        self.dec = [make(dim, seed + 1 + len(head_dims) + i) for i, dim in enumerate(dec_dims)]
+        self.share_dim = min(share_dim, k)
+        self.head_dims = [min(dim, k) for dim in head_dims]
+        self.dec_dims = [min(dim, k) for dim in dec_dims]
+
+    @staticmethod
+    def _apply(sketch, grad):
+        return grad if sketch is None else sketch(grad)
+
+    def __call__(self, cop, grad_share, grad_head, grad_dec):
+        return self._apply(self.share, grad_share), self._apply(self.head[cop], grad_head), \
+            self._apply(self.dec[cop], grad_dec)
@@ -11,6 +11,50 @@ def get_options():
                                                                )
 
     parser.add_argument('--warm_start', type=int, default=1, help='number of epochs to warm start ')
+    parser.add_argument('--similarity_mode', default='store', choices=['store', 'stream'],
+                        help='store: keep the gradients of the selection window and compute the influence matrix at '
+                             'its end, stream: update the gradient similarities as each gradient arrives')
+    parser.add_argument('--grow_gradient_store', action='store_true',
+                        help='grow the gradient store for a window longer than select_freq*pack steps (the '
+                             'warm-start one) so it keeps all of its gradients as the former lists did, by default '
+                             'the store keeps select_freq*pack rows and folds the oldest gradients of such a window '
+                             'into the last gradient of their arm')
+    parser.add_argument('--sketch_dim', type=int, default=None,
+                        help='if set, record random projections of this size instead of the full gradients')
+    parser.add_argument('--sketch_type', default='countsketch', choices=['countsketch', 'gaussian', 'rademacher'],
+                        help='random projection used by --sketch_dim')
+    parser.add_argument('--sketch_seed', type=int, default=1234, help='seed of the random projections')
+    parser.add_argument('--sketch_report', action='store_true',
+                        help='also track the exact similarities and log the error of the sketched ones')
+    parser.add_argument('--pack', type=int, default=1,
+                        help='number of arms trained together in one step, their problems go through the encoder '
+                             'in one pass and their losses are averaged, each arm has a backward of its own so '
+                             'the bandit records its own gradient. every arm of a step trains on train_batch_size '
+                             'episodes, so an epoch takes pack times fewer steps and gradient all-reduces')
+    parser.add_argument('--amp', default=None, choices=['bf16', 'fp16'],
+                        help='run the model forward under autocast with this dtype (fp16 with loss scaling)')
+    parser.add_argument('--micro_batch', nargs='+', type=str, default=None,
+                        help='micro-batch sizes whose gradients are accumulated into one step, per task as e.g. '
+                             'CVRP100:128 KP200:64, over the micro_batch table of config.yaml. auto probes the '
+                             'memory of the other tasks on their first step (cuda only), else a size without a task '
+                             'applies to them')
+    parser.add_argument('--rollout', default='sequential', choices=['sequential', 'two_phase'],
+                        help='sequential: keep the graph of every decoding step, two_phase: sample without gradients '
+                             'then recompute the log-probabilities in one teacher-forced decoder pass')
+    parser.add_argument('--rollout_chunk', type=int, default=None,
+                        help='number of decoding steps per chunk of the teacher-forced pass')
+    parser.add_argument('--rollout_checkpoint', action='store_true',
+                        help='recompute the activations of each teacher-forced chunk in the backward pass')
+    parser.add_argument('--compact', type=float, default=None,
+                        help='drop the finished CVRP, OP and KP instances from the training and validation rollouts '
+                             'once this fraction of them is finished, not with --rollout two_phase')
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help='number of scheduled steps whose random instances are generated ahead in a background '
+                             'thread, 0 generates them at the start of each step')
+    parser.add_argument('--async_bandit', action='store_true',
+                        help='compute the Gram matrices, the rewards and the bandit update of a window in the '
+                             'background, the choices made before the update is done use the posterior of the window '
+                             'before. the gradient store keeps a second set of buffers for the next window')
 
 
 
@@ -39,6 +83,8 @@ def get_options():
     parser.add_argument('--train_batch_size', type=int, default=64)
 
     parser.add_argument('--evaluation_size', type=int, default=1024)
+    parser.add_argument('--val_seed', type=int, default=1234,
+                        help='seed of the validation instances, each rank generates its shard from it')
     parser.add_argument('--model_save_interval', type=int, default=50)
     parser.add_argument('--model_load', action='store_true')
     parser.add_argument('--resume_path', type=str, default=None)
@@ -46,5 +92,11 @@ def get_options():
 
     parser.add_argument('--task_description', type=str, default=None)
 
+    # device
+    parser.add_argument('--device', default='cuda', choices=['cuda', 'cpu'],
+                        help='cuda: one process per GPU with nccl, cpu: --world_size processes with gloo')
+    parser.add_argument('--world_size', type=int, default=None,
+                        help='number of processes, defaults to the number of GPUs with cuda and 1 with cpu')
+
     opts = parser.parse_args()
     return opts
\ No newline at end of file
@@ -0,0 +1,63 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+
+def _to(problems, fn):
+    # problems: a tensor or a tuple of tensors, as returned by env.random_problems
+    if isinstance(problems, torch.Tensor):
+        return fn(problems)
+    return tuple(fn(p) for p in problems)
+
+
+class InstancePrefetcher:
+    # Generates the random instances of the next steps on the CPU in a background thread, while the current step
+    # trains. the keys start with the index of the step the batch is for and are put in step order. get drops the
+    # batches of the earlier steps, which can no longer be used, and leaves the ones of the later steps queued.
+    # pinned batches are copied to the device without blocking the host.
+    def __init__(self, device, pin_memory=True):
+        self.device = device
+        self.pin_memory = pin_memory and device.type == 'cuda'
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = deque()
+        # (key, batch_size, future)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.generation_time = 0.
+        self.wait_time = 0.
+
+    def _generate(self, generate, batch_size):
+        s = time.time()
+        problems = generate(batch_size, device='cpu')
+        if self.pin_memory:
+            problems = _to(problems, lambda p: p.pin_memory())
+        self.generation_time += time.time() - s
+        return problems
+
+    def put(self, key, generate, batch_size):
+        # generate: env.random_problems
+        self.queue.append((key, batch_size, self.executor.submit(self._generate, generate, batch_size)))
+
+    def get(self, key, batch_size):
+        # the batch put for key on the device, None if it was not prefetched with this batch size
+        while len(self.queue) > 0 and self.queue[0][0][0] < key[0]:
+            self.queue.popleft()[2].cancel()
+        for i, (queued_key, queued_size, future) in enumerate(self.queue):
+            if queued_key != key:
+                continue
+            del self.queue[i]
+            if queued_size != batch_size:
+                future.cancel()
+                break
+            s = time.time()
+            problems = future.result()
+            self.wait_time += time.time() - s
+            self.hits += 1
+            return _to(problems, lambda p: p.to(self.device, non_blocking=True))
+        self.misses += 1
+        return None
@@ -0,0 +1,64 @@
+import torch
+
+
+def rollout(model, env, problem, state, reward, done, compact=None):
+    # decode until done, keeping the running sum of the log-probabilities of the selected nodes
+    # compact: with the envs that have a compact method (CVRP, OP, KP), once this fraction of the decoded instances
+    # is finished, they are dropped from the env and the decoder caches, the reward and the log-probabilities
+    # are still returned for the whole batch
+    inner_model = model.module if hasattr(model, 'module') else model
+    log_prob = torch.zeros(size=state.BATCH_IDX.shape)
+    # shape: (batch, pomo)
+    rows = None
+    # index in the batch of the instances still decoded, None if not compacted
+    while not done:
+        selected, step_log_prob = model(state, problem)
+        # shape: (batch, pomo)
+        state, reward, done = env.step(selected)
+        if step_log_prob is not None:
+            log_prob = log_prob + step_log_prob if rows is None else log_prob.index_add(0, rows, step_log_prob)
+        if compact is not None and not done and hasattr(env, 'compact'):
+            finished = state.finished.all(dim=1)
+            # shape: (batch,)
+            num_finished = finished.sum().item()
+            if num_finished > 0 and num_finished >= compact * finished.size(0):
+                state = env.compact(~finished)
+                inner_model.compact(problem, ~finished)
+                rows = env.instance_idx
+    return reward, log_prob
+
+
+def two_phase_rollout(model, env, problem, state, reward, done, chunk_steps=None, use_checkpoint=False):
+    # sample the trajectories without building a graph, keeping what the decoder was fed at every step,
+    # then compute the log-probabilities of the sampled nodes in one teacher-forced decoder pass
+    inner_model = model.module if hasattr(model, 'module') else model
+    nodes, features, masks, selected_list = [], [], [], []
+    with torch.no_grad():
+        while not done:
+            inputs = inner_model.decoder_inputs(state, problem)
+            selected, _ = model(state, problem)
+            # shape: (batch, pomo)
+            if inputs is not None:
+                nodes.append(inputs[0])
+                features.append(inputs[1])
+                masks.append(inputs[2])
+                selected_list.append(selected)
+            state, reward, done = env.step(selected)
+
+    batch_size, pomo_size = state.BATCH_IDX.shape
+    if len(masks) == 0:
+        return reward, torch.zeros(size=(batch_size, pomo_size))
+
+    def fold(steps):
+        # (steps, batch, pomo, ...) -> (batch, steps*pomo, ...)
+        if steps[0] is None:
+            return None
+        stacked = torch.stack(steps, dim=1)
+        return stacked.reshape(batch_size, len(steps) * pomo_size, *stacked.shape[3:])
+
+    teacher_forcing = dict(nodes=fold(nodes), features=fold(features), masks=fold(masks),
+                           selected=fold(selected_list), pomo_size=pomo_size, chunk_steps=chunk_steps,
+                           use_checkpoint=use_checkpoint)
+    log_prob = model(state, problem, teacher_forcing=teacher_forcing)
+    # shape: (batch, pomo)
+    return reward, log_prob
@@ -38,7 +38,7 @@ def main(opts):
     problem_list = list(test_env_params.keys())
 
     tester_params = {
-        'use_cuda': True if opts.device_num is not None else False,
+        'use_cuda': opts.device == 'cuda' and opts.device_num is not None,
         'cuda_device_num': opts.device_num,
         'model_load': {
             'path': opts.model_path,  # directory path of pre-trained model and log files saved.
@@ -49,6 +49,7 @@ def main(opts):
         'augmentation_enable': True if opts.aug_factor is not None else False,
         'aug_factor': opts.aug_factor,
         'aug_batch_size': opts.aug_batch_size,
+        'compact': opts.compact,
     }
     if tester_params['augmentation_enable']:
         tester_params['test_batch_size'] = tester_params['aug_batch_size']
@@ -129,10 +130,14 @@ if __name__ == "__main__":
     parser.add_argument('--test_batch_size', type=int, default=500)
     parser.add_argument('--aug_factor', type=int, default=8)
     parser.add_argument('--aug_batch_size', type=int, default=500)
+    parser.add_argument('--compact', type=float, default=None,
+                        help='drop the finished CVRP, OP and KP instances from the rollouts once this fraction of '
+                             'them is finished')
 
     parser.add_argument('--model_path', type=str, default=None)
     parser.add_argument('--model_epoch', type=int, default=None)
     parser.add_argument('--device_num', type=int, default=0)
+    parser.add_argument('--device', default='cuda', choices=['cuda', 'cpu'])
     parser.add_argument('--task_description', type=str, default=None)
 
     opts = parser.parse_args()
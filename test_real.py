@@ -22,7 +22,7 @@ def main(opts):
         ds = 'cvrp'
 
     tester_params = {
-        'use_cuda': True if opts.device_num is not None else False,
+        'use_cuda': opts.device == 'cuda' and opts.device_num is not None,
         'cuda_device_num': opts.device_num,
         'model_load': {
             'path': opts.model_path,  # directory path of pre-trained model and log files saved.
@@ -77,6 +77,7 @@ if __name__ == "__main__":
     parser.add_argument('--model_path', type=str, default=None)
     parser.add_argument('--model_epoch', type=int, default=None)
     parser.add_argument('--device_num', type=int, default=0)
+    parser.add_argument('--device', default='cuda', choices=['cuda', 'cpu'])
     parser.add_argument('--task_description', type=str, default=None)
 
     opts = parser.parse_args()
@@ -26,10 +26,10 @@ def find_available_port():
         torch.distributed.destroy_process_group()
     return port
 
-def setup(rank, world_size):
+def setup(rank, world_size, backend="nccl"):
     os.environ['MASTER_ADDR'] = 'localhost'
     # initialize the process group
-    dist.init_process_group("nccl", rank=rank, world_size=world_size)
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
 
 def cleanup():
     dist.destroy_process_group()
@@ -43,7 +43,12 @@ def _print_config(trainer_params):
 
 def ddp_train(rank, world_size, env_params, model_params, trainer_params, optimizer_params, logger_params, opts):
     print(f"DDP training on rank {rank}.")
-    setup(rank, world_size)
+    if trainer_params['use_cuda']:
+        setup(rank, world_size, "nccl")
+    else:
+        # share the cores between the processes instead of each using all of them
+        torch.set_num_threads(max(1, os.cpu_count() // world_size))
+        setup(rank, world_size, "gloo")
     main(rank, opts,  env_params, model_params, trainer_params, optimizer_params, logger_params)
     cleanup()
 
@@ -161,9 +166,13 @@ if __name__ == "__main__":
                                                          '-'.join(str(_)+str(unseen_env_params[_]['problem_size']) for _ in unseen_problem_list),
                                                          opts.task_description)
 
-    n_gpus = torch.cuda.device_count()
-    world_size = n_gpus
-    assert n_gpus >= world_size, f"Requires at least {world_size} GPUs to run, but got {n_gpus}"
+    trainer_params['use_cuda'] = opts.device == 'cuda'
+    if trainer_params['use_cuda']:
+        n_gpus = torch.cuda.device_count()
+        world_size = n_gpus if opts.world_size is None else opts.world_size
+        assert n_gpus >= world_size, f"Requires at least {world_size} GPUs to run, but got {n_gpus}"
+    else:
+        world_size = 1 if opts.world_size is None else opts.world_size
     trainer_params['train_episodes'] = opts.train_episodes//world_size
     trainer_params['train_batch_size'] = opts.train_batch_size
     opts.evaluation_size = opts.evaluation_size//world_size if opts.evaluation_size%world_size ==0 else opts.evaluation_size//world_size + 1
@@ -38,6 +38,7 @@ import json
 import shutil
 import torch
 import networkx as nx
+from concurrent.futures import ThreadPoolExecutor
 
 import tsplib95
 import pandas as pd
@@ -113,6 +114,53 @@ class AverageMeter:
         return self.sum / self.count if self.count else 0
 
 
+class AsyncWorker:
+    # Runs one submitted function at a time on a background thread, on a side stream when the device is a GPU.
+    # submit waits for the previous function first, so its results are at most one submission stale.
+    # join returns what the function returned.
+    def __init__(self, device=None):
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.stream = torch.cuda.Stream(device) if device is not None and device.type == 'cuda' else None
+        self.future = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.count = 0
+        self.busy_time = 0.
+        self.wait_time = 0.
+
+    def _run(self, fn, args):
+        s = time.time()
+        if self.stream is None:
+            out = fn(*args)
+        else:
+            with torch.cuda.stream(self.stream):
+                out = fn(*args)
+            self.stream.synchronize()
+        self.busy_time += time.time() - s
+        return out
+
+    def submit(self, fn, *args):
+        self.join()
+        if self.stream is not None:
+            # the inputs are produced on the current stream
+            self.stream.wait_stream(torch.cuda.current_stream(self.stream.device))
+        self.future = self.executor.submit(self._run, fn, args)
+        self.count += 1
+
+    def done(self):
+        return self.future is None or self.future.done()
+
+    def join(self):
+        if self.future is None:
+            return
+        s = time.time()
+        out = self.future.result()
+        self.wait_time += time.time() - s
+        self.future = None
+        return out
+
+
 class LogData:
     def __init__(self):
         self.keys = set()